@@ -1,11 +1,139 @@
+import argparse
+import bisect
+import csv
+import heapq
+import itertools
 import json
+import os
 import random
+import re
+import signal
+import sys
+import threading
 import time
 import logging
+import multiprocessing
+import zlib
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+
+# paho-mqtt, requests and PyYAML are imported where they are used, so that importing Cbox (to embed or benchmark
+# its components) stays fast and free of side effects
+
+try:
+    # Optional, decodes the boxes responses faster when installed
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
+################
+
+class StateField:
+    __slots__ = ("name", "key", "topic", "converter", "deadband", "sensor", "device_class", "unit")
+
+    def __init__(self, name, key, topic, converter, deadband=False, sensor=None, device_class=None, unit=None):
+        self.name = name
+        self.key = key
+        self.topic = topic
+        self.converter = converter
+        self.deadband = deadband
+        self.sensor = sensor
+        self.device_class = device_class
+        self.unit = unit
+
+
+def identity(value):
+    return value
+
+
+# Maps each field of the box "DATA" payload to a Device state attribute, its state topic suffix, the
+# conversion applied to the raw value and, for the values that are exposed as their own HA sensor, the
+# discovery metadata (unit is the name of the Config attribute holding the unit)
+STATE_FIELDS = (
+    StateField("target_temperature", "SETP", "target_temp", identity),
+    StateField("room_temperature", "T1", "temp", identity, deadband=True),
+    StateField("exit_temperature", "T2", "exit_temp", identity, deadband=True,
+               sensor="exit temperature", device_class="temperature", unit="temperature_unit"),
+    StateField("fumes_temperature", "T3", "fumes_temp", identity, deadband=True,
+               sensor="fumes temperature", device_class="temperature", unit="temperature_unit"),
+    StateField("pellet_quantity", "PQT", "pellet_qty", float, deadband=True,
+               sensor="pellet quantity", unit="pellet_quantity_unit"),
+    StateField("fan_speed", "F2L", "fan_speed", lambda value: Device.fanspd_names.get(value, "Off"),
+               sensor="fan speed"),
+    StateField("power_level", "PWR", "power_level", identity, sensor="power level"),
+    StateField("timer_state", "CHRSTATUS", "timer", lambda value: "on" if value == 1 else "off", sensor="timer"),
+    StateField("status", "LSTATUS", "status", lambda value: Device.status_names.get(value, "Off"), sensor="status"),
+    StateField("mode", "LSTATUS", "mode", lambda value: "heat" if value in Device.is_heating_statuses else "off"),
+)
+
+# Keys of the box "DATA" payload that the bridge reads
+STATE_KEYS = frozenset([field.key for field in STATE_FIELDS] + ["MAC"])
+
+# Climate discovery keys that point to the state topic of a field
+CLIMATE_STATE_TOPICS = (
+    ("current_temperature_topic", "room_temperature"),
+    ("mode_state_topic", "mode"),
+    ("temperature_state_topic", "target_temperature"),
+    ("fan_mode_state_topic", "fan_speed"),
+    ("hold_state_topic", "power_level"),
+    ("swing_mode_state_topic", "timer_state"),
+)
+
+def parse_choice(*choices):
+    def parse(payload):
+        if payload not in choices:
+            raise ValueError("expected one of " + ", ".join(choices))
+        return payload
+    return parse
+
+
+# Plain ASCII numbers only: float() and int() also take unicode digits, exponents, signs, "nan" and "inf"
+DECIMAL_PAYLOAD = re.compile(r"[0-9]+(\.[0-9]+)?")
+INTEGER_PAYLOAD = re.compile(r"[0-9]+")
+
+# Setpoints outside this range (in °C, whatever temperature_unit says) are never meant for a stove
+TARGET_TEMPERATURE_RANGE = (5, 40)
+
+
+def parse_temperature(payload):
+    payload = payload.strip()
+    if DECIMAL_PAYLOAD.fullmatch(payload) is None:
+        raise ValueError("expected a temperature")
+    temperature = round(float(payload), 1)
+    low, high = TARGET_TEMPERATURE_RANGE
+    if not low <= temperature <= high:
+        raise ValueError("expected a temperature between {} and {}".format(low, high))
+    return "{:g}".format(temperature)
+
+
+def parse_pellet_refill(payload):
+    # "full" (or nothing) when the tank was filled up, otherwise the quantity that was poured in
+    if payload in ("", "full"):
+        return None
+    quantity = float(payload)
+    if not quantity > 0 or quantity == float("inf"):
+        raise ValueError("expected 'full' or a positive pellet quantity")
+    return quantity
+
+
+def parse_power_level(payload):
+    payload = payload.strip()
+    if INTEGER_PAYLOAD.fullmatch(payload) is None or int(payload) not in range(1, 6):
+        raise ValueError("expected a power level between 1 and 5")
+    return str(int(payload))
+
+
+# Climate discovery keys that point to a command topic, with the topic suffix, the Device method handling it and the
+# parser that validates the payload (raising ValueError) before anything is sent to the box
+CLIMATE_COMMAND_TOPICS = (
+    ("mode_command_topic", "mode", "send_mode", parse_choice("off", "heat")),
+    ("temperature_command_topic", "target_temp", "send_target_temperature", parse_temperature),
+    ("fan_mode_command_topic", "fan_speed", "send_fan_speed", parse_choice("off", "1", "2", "3", "4", "5", "hi", "auto")),
+    ("hold_command_topic", "power_level", "send_power_level", parse_power_level),
+    ("swing_mode_command_topic", "timer", "send_timer", parse_choice("on", "off")),
+)
 
-import paho.mqtt.client as mqtt
-import requests
-import yaml
 
 ################
 
@@ -73,242 +201,291 @@ class Device:
     }
 
     is_heating_statuses = [2, 3, 4, 5, 502, 503, 504, 51, 6, 7]
+    # Statuses that only last a few minutes before the stove moves on, and the errors, polled at the fastest pace
+    is_transition_statuses = [1, 10, 11, 12, 2, 3, 4, 5, 50, 502, 503, 505, 506, 507]
+    # Statuses the stove can stay in for hours, polled slowly once they last
+    is_idle_statuses = [0, 501, 9]
 
     def __init__(self, house, device_id, name, hostname):
         self.house = house
         self.device_id = device_id
         self.name = name
         self.hostname = hostname
-        self.climate_discovery_topic = None
-        self.climate_mqtt_config = None
-        self.status_sensor_discovery_topic = None
-        self.status_sensor_mqtt_config = None
-        self.exit_temp_sensor_discovery_topic = None
-        self.exit_temp_sensor_mqtt_config = None
-        self.fumes_temp_sensor_discovery_topic = None
-        self.fumes_temp_sensor_mqtt_config = None
-        self.pellet_qty_sensor_discovery_topic = None
-        self.pellet_qty_sensor_mqtt_config = None
-        self.fan_spd_sensor_discovery_topic = None
-        self.fan_spd_sensor_mqtt_config = None
-        self.power_lvl_sensor_discovery_topic = None
-        self.power_lvl_sensor_mqtt_config = None
-        self.timer_sensor_discovery_topic = None
-        self.timer_sensor_mqtt_config = None
-        self.target_temperature = None
-        self.temp_step = None
-        self.room_temperature = None
-        self.exit_temperature = None
-        self.fumes_temperature = None
-        self.pellet_quantity = None
-        self.fan_speed = None
-        self.power_level = None
-        self.timer_state = None
-        self.status = None
-        self.mode = None
-        self.topic_to_func = None
+        self.state = DeviceState()
         self.availability = "offline"
         self.last_update = 0
+        self.last_full_update = 0
+        self.full_poll_requested = False
+        self.full_data = None
+        self.status_code = None
+        self.status_since = 0
+        self.delayer = Delayer(house.config.refresh_delays, house.config.refresh_delay_randomness)
+        self.history = None
+        if house.config.history_window:
+            self.history = History(house.config.history_size, house.config.history_window)
+        self.history_topic = None
+        self.pellets = PelletEstimator(house.config.pellet_rate_smoothing)
+        self.pellet_topics = {}
+        self.published_values = {}
+        self.last_full_publish = 0
+        self.state_topics = {}
+        self.availability_topic = None
+        self.published_availability = None
+        self.availability_key = ("availability", device_id)
+        self.discovery_configs = {}
+        self.discovery_payloads = {}
+        self.mqtt_config_key = None
+        # Command topic: (device, handler, payload parser, whether the handler calls the box)
+        self.command_routes = {}
+        self.commands = CommandQueue(self)
 
     def __str__(self):
         return json.dumps({
             'name': self.name,
             'hostname': self.hostname,
-            'climate_discovery_topic': self.climate_discovery_topic,
-            'climate_mqtt_config': self.climate_mqtt_config,
-            'status_sensor_discovery_topic': self.status_sensor_discovery_topic,
-            'status_sensor_mqtt_config': self.status_sensor_mqtt_config,
-            'exit_temp_sensor_discovery_topic': self.exit_temp_sensor_discovery_topic,
-            'exit_temp_sensor_mqtt_config': self.exit_temp_sensor_mqtt_config,
-            'fumes_temp_sensor_discovery_topic': self.fumes_temp_sensor_discovery_topic,
-            'fumes_temp_sensor_mqtt_config': self.fumes_temp_sensor_mqtt_config,
-            'pellet_qty_sensor_discovery_topic': self.pellet_qty_sensor_discovery_topic,
-            'pellet_qty_sensor_mqtt_config': self.pellet_qty_sensor_mqtt_config,
-            'fan_spd_sensor_discovery_topic': self.fan_spd_sensor_discovery_topic,
-            'fan_spd_sensor_mqtt_config': self.fan_spd_sensor_mqtt_config,
-            'power_lvl_sensor_discovery_topic': self.power_lvl_sensor_discovery_topic,
-            'power_lvl_sensor_mqtt_config': self.power_lvl_sensor_mqtt_config,
-            'timer_sensor_discovery_topic': self.timer_sensor_discovery_topic,
-            'timer_sensor_mqtt_config': self.timer_sensor_mqtt_config,
-            'target_temperature': self.target_temperature,
-            'temp_step': self.temp_step,
-            'room_temperature': self.room_temperature,
-            'exit_temperature': self.exit_temperature,
-            'fumes_temperature': self.fumes_temperature,
-            'pellet_quantity': self.pellet_quantity,
-            'fan_speed': self.fan_speed,
-            'power_level': self.power_level,
-            'timer_state': self.timer_state,
-            'status': self.status,
-            'mode': self.mode
+            'discovery_configs': self.discovery_configs,
+            'state': self.state.as_dict(),
+            'availability': self.availability
         })
 
     def update_state(self, data):
-        self.target_temperature = data["SETP"]
-        self.temp_step = self.house.config.temp_step
-        self.room_temperature = data["T1"]
-        self.exit_temperature = data["T2"]
-        self.fumes_temperature = data["T3"]
-        self.pellet_quantity = float(data["PQT"])
-        self.fan_speed = self.fanspd_names.get(data["F2L"], "Off")
-        self.power_level = data["PWR"]
-        self.timer_state = "on" if data["CHRSTATUS"] == 1 else "off"
-        self.status = self.status_names.get(data["LSTATUS"], "Off")
-        self.mode = "heat" if data["LSTATUS"] in self.is_heating_statuses else "off"
-        if time.time() - self.last_update < self.house.config.offline_timeout:
-            self.availability = "online"
-        else:
-            self.availability = "offline"
+        state = self.state
+        for field in STATE_FIELDS:
+            if field.key in data:
+                setattr(state, field.name, field.converter(data[field.key]))
+        if "LSTATUS" in data and data["LSTATUS"] != self.status_code:
+            self.status_code = data["LSTATUS"]
+            self.status_since = time.time()
         self.last_update = time.time()
+        # Goes offline when the deadline passes without another answer, whether polls keep failing or stop
+        self.availability = "online"
+        self.house.scheduler.schedule(self.availability_key, self.house.config.offline_timeout)
+        if self.history is not None:
+            aggregate = self.history.add(self.last_update, [getattr(state, name) for name in History.fields])
+            if aggregate is not None:
+                self.house.export_history(self, aggregate)
+        self.pellets.add(self.last_update, state.pellet_quantity, state.power_level, state.mode == "heat")
+
+    def refresh_delay(self):
+        # Poll where the state actually changes: fast while the stove goes through a transition or an error, slowly
+        # when it stays off, at the refresh_delays pace otherwise (and always right after a command)
+        config = self.house.config
+        status_code = self.status_code
+        if config.transition_refresh_delay is not None and (
+                status_code in self.is_transition_statuses or (status_code or 0) >= 1000):
+            self.delayer.reset()
+            return config.transition_refresh_delay
+        settled = self.delayer.settled()
+        delay = self.delayer.next()
+        if config.idle_refresh_delay is not None and status_code in self.is_idle_statuses \
+                and time.time() - self.status_since >= config.idle_after and settled:
+            return max(delay, config.idle_refresh_delay)
+        return delay
+
+    def state_topic(self, suffix):
+        return sys.intern(self.house.config.mqtt_state_prefix + "/" + self.device_id + "/" + suffix)
+
+    def command_topic(self, suffix):
+        return sys.intern(self.house.config.mqtt_command_prefix + "/" + self.device_id + "/" + suffix)
+
+    def discovery_topic(self, component, object_id):
+        return sys.intern(self.house.config.mqtt_discovery_prefix + "/" + component + "/" + object_id + "/config")
+
+    def current_mqtt_config_key(self, config=None, name=None):
+        # Everything the topics and the discovery payloads are built from
+        config = config if config is not None else self.house.config
+        return (self.device_id, name if name is not None else self.name, config.mqtt_discovery_prefix,
+                config.mqtt_state_prefix, config.mqtt_command_prefix, config.temp_step, config.temperature_unit,
+                config.pellet_quantity_unit, config.pellet_tank_capacity, config.mqtt_bridge_availability_topic)
 
     def update_mqtt_config(self):
-        self.climate_discovery_topic = self.house.config.mqtt_discovery_prefix + "/climate/" + self.device_id + "/config"
-        self.climate_mqtt_config = {
+        mqtt_config_key = self.current_mqtt_config_key()
+        if mqtt_config_key == self.mqtt_config_key:
+            return
+        config = self.house.config
+        self.state_topics = {field.name: self.state_topic(field.topic) for field in STATE_FIELDS}
+        self.availability_topic = self.state_topic("availability")
+        self.history_topic = self.state_topic("history")
+        # Entities are available only while both the bridge and the box are
+        availability = [{"topic": config.mqtt_bridge_availability_topic}, {"topic": self.availability_topic}]
+        self.pellet_topics = {name: self.state_topic(suffix) for name, suffix, _, _ in PelletEstimator.sensors}
+        if config.pellet_tank_capacity is None:
+            del self.pellet_topics["hours_left"]
+
+        climate_mqtt_config = {
             "name": self.name,
             "unique_id": self.device_id,
-
-            "current_temperature_topic": self.house.config.mqtt_state_prefix + "/" + self.device_id + "/temp",
-            "mode_state_topic": self.house.config.mqtt_state_prefix + "/" + self.device_id + "/mode",
-            "temperature_state_topic": self.house.config.mqtt_state_prefix + "/" + self.device_id + "/target_temp",
-            "fan_mode_state_topic": self.house.config.mqtt_state_prefix + "/" + self.device_id + "/fan_speed",
-            "hold_state_topic": self.house.config.mqtt_state_prefix + "/" + self.device_id + "/power_level",
-            "swing_mode_state_topic": self.house.config.mqtt_state_prefix + "/" + self.device_id + "/timer",
-            "availability_topic": self.house.config.mqtt_state_prefix + "/" + self.device_id + "/availability",
-
-            "mode_command_topic": self.house.config.mqtt_command_prefix + "/" + self.device_id + "/mode",
-            "temperature_command_topic": self.house.config.mqtt_command_prefix + "/" + self.device_id + "/target_temp",
-            "temp_step": self.house.config.mqtt_command_prefix + "/" + self.device_id + "/temp_step",
-            "fan_mode_command_topic": self.house.config.mqtt_command_prefix + "/" + self.device_id + "/fan_speed",
-            "hold_command_topic": self.house.config.mqtt_command_prefix + "/" + self.device_id + "/power_level",
-            "swing_mode_command_topic": self.house.config.mqtt_command_prefix + "/" + self.device_id + "/timer",
+            "availability": availability,
+            "availability_mode": "all",
+            "temp_step": config.temp_step,
             "hold_modes": ["1", "2", "3", "4", "5"],
             "modes": ["off", "heat"],
             "fan_modes": ["off", "1", "2", "3", "4", "5", "hi", "auto"],
             "device": {"identifiers": self.device_id, "manufacturer": "Palazzetti"}
         }
-        self.topic_to_func = {
-            self.climate_mqtt_config["mode_command_topic"]: self.send_mode,
-            self.climate_mqtt_config["temperature_command_topic"]: self.send_target_temperature,
-            self.climate_mqtt_config["fan_mode_command_topic"]: self.send_fan_speed,
-            self.climate_mqtt_config["hold_command_topic"]: self.send_power_level,
-            self.climate_mqtt_config["swing_mode_command_topic"]: self.send_timer,
-        }
-        self.status_sensor_discovery_topic = self.house.config.mqtt_discovery_prefix + "/sensor/" + self.device_id + "_status/config"
-        self.status_sensor_mqtt_config = {
-            "name": self.name + " (status)",
-            "state_topic": self.house.config.mqtt_state_prefix + "/" + self.device_id + "/status"
-        }
-        self.exit_temp_sensor_discovery_topic = self.house.config.mqtt_discovery_prefix + "/sensor/" + self.device_id + "_exit_temp/config"
-        self.exit_temp_sensor_mqtt_config = {
-            "name": self.name + " (exit temperature)",
-            "device_class": "temperature",
-            "unit_of_measurement": self.house.config.temperature_unit,
-            "state_topic": self.house.config.mqtt_state_prefix + "/" + self.device_id + "/exit_temp"
-        }
-        self.fumes_temp_sensor_discovery_topic = self.house.config.mqtt_discovery_prefix + "/sensor/" + self.device_id + "_fumes_temp/config"
-        self.fumes_temp_sensor_mqtt_config = {
-            "name": self.name + " (fumes temperature)",
-            "device_class": "temperature",
-            "unit_of_measurement": self.house.config.temperature_unit,
-            "state_topic": self.house.config.mqtt_state_prefix + "/" + self.device_id + "/fumes_temp"
-        }
-        self.pellet_qty_sensor_discovery_topic = self.house.config.mqtt_discovery_prefix + "/sensor/" + self.device_id + "_pellet_qty/config"
-        self.pellet_qty_sensor_mqtt_config = {
-            "name": self.name + " (pellet quantity)",
-            "unit_of_measurement": self.house.config.pellet_quantity_unit,
-            "state_topic": self.house.config.mqtt_state_prefix + "/" + self.device_id + "/pellet_qty"
+        self.command_routes = {}
+        for climate_key, field_name in CLIMATE_STATE_TOPICS:
+            climate_mqtt_config[climate_key] = self.state_topics[field_name]
+        for climate_key, suffix, method_name, parser in CLIMATE_COMMAND_TOPICS:
+            topic = self.command_topic(suffix)
+            climate_mqtt_config[climate_key] = topic
+            self.command_routes[topic] = (self, getattr(self, method_name), parser, True)
+        self.discovery_configs = {self.discovery_topic("climate", self.device_id): climate_mqtt_config}
+
+        for field in STATE_FIELDS:
+            if field.sensor is None:
+                continue
+            sensor_mqtt_config = {
+                "name": self.name + " (" + field.sensor + ")",
+                "state_topic": self.state_topics[field.name],
+                "availability": availability,
+                "availability_mode": "all"
+            }
+            if field.device_class is not None:
+                sensor_mqtt_config["device_class"] = field.device_class
+            if field.unit is not None:
+                sensor_mqtt_config["unit_of_measurement"] = getattr(config, field.unit)
+            self.discovery_configs[self.discovery_topic("sensor", self.device_id + "_" + field.topic)] = sensor_mqtt_config
+
+        for name, suffix, sensor, unit in PelletEstimator.sensors:
+            if name not in self.pellet_topics:
+                continue
+            self.discovery_configs[self.discovery_topic("sensor", self.device_id + "_" + suffix)] = {
+                "name": self.name + " (" + sensor + ")",
+                "state_topic": self.pellet_topics[name],
+                "unit_of_measurement": unit.format(config.pellet_quantity_unit),
+                "availability": availability,
+                "availability_mode": "all"
+            }
+        refill_topic = self.command_topic("pellet_refill")
+        self.command_routes[refill_topic] = (self, self.apply_pellet_refill, parse_pellet_refill, False)
+        self.discovery_configs[self.discovery_topic("button", self.device_id + "_pellet_refill")] = {
+            "name": self.name + " (pellet refill)",
+            "command_topic": refill_topic,
+            "payload_press": "full",
+            "availability": [{"topic": config.mqtt_bridge_availability_topic}]
         }
 
+        self.discovery_payloads = {topic: json.dumps(mqtt_config).encode("utf-8")
+                                   for topic, mqtt_config in self.discovery_configs.items()}
+        self.mqtt_config_key = mqtt_config_key
+
     def register_mqtt(self):
-        mqtt_client = self.house.mqtt_client
+        publisher = self.house.publisher
 
-        mqtt_client.subscribe(self.climate_mqtt_config["mode_command_topic"], 0)
-        mqtt_client.subscribe(self.climate_mqtt_config["temperature_command_topic"], 0)
-        mqtt_client.subscribe(self.climate_mqtt_config["fan_mode_command_topic"], 0)
-        mqtt_client.subscribe(self.climate_mqtt_config["hold_command_topic"], 0)
-        mqtt_client.subscribe(self.climate_mqtt_config["swing_mode_command_topic"], 0)
+        for topic in self.command_routes:
+            publisher.subscribe(topic, 0)
+        self.house.routes.update(self.command_routes)
 
         if self.house.config.mqtt_discovery:
             retain = self.house.config.mqtt_config_retain
-            mqtt_client.publish(self.climate_discovery_topic, json.dumps(self.climate_mqtt_config),
-                                qos=1, retain=retain)
-            mqtt_client.publish(self.status_sensor_discovery_topic, json.dumps(self.status_sensor_mqtt_config),
-                                qos=1, retain=retain)
-            mqtt_client.publish(self.exit_temp_sensor_discovery_topic, json.dumps(self.exit_temp_sensor_mqtt_config),
-                                qos=1, retain=retain)
-            mqtt_client.publish(self.fumes_temp_sensor_discovery_topic, json.dumps(self.fumes_temp_sensor_mqtt_config),
-                                qos=1, retain=retain)
-            mqtt_client.publish(self.pellet_qty_sensor_discovery_topic, json.dumps(self.pellet_qty_sensor_mqtt_config),
-                                qos=1, retain=retain)
+            for topic, payload in self.discovery_payloads.items():
+                self.house.publish(topic, payload, qos=1, retain=retain, kind="discovery")
 
     def unregister_mqtt(self):
-        mqtt_client = self.house.mqtt_client
+        publisher = self.house.publisher
 
-        mqtt_client.unsubscribe(self.climate_mqtt_config["mode_command_topic"], 0)
-        mqtt_client.unsubscribe(self.climate_mqtt_config["temperature_command_topic"], 0)
-        mqtt_client.unsubscribe(self.climate_mqtt_config["fan_mode_command_topic"], 0)
-        mqtt_client.unsubscribe(self.climate_mqtt_config["hold_command_topic"], 0)
-        mqtt_client.unsubscribe(self.climate_mqtt_config["swing_mode_command_topic"], 0)
+        for topic in self.command_routes:
+            publisher.unsubscribe(topic)
+            self.house.routes.pop(topic, None)
 
         if self.house.config.mqtt_discovery:
             retain = self.house.config.mqtt_config_retain
-            mqtt_client.publish(self.climate_discovery_topic, None, qos=1, retain=retain)
-            mqtt_client.publish(self.status_sensor_discovery_topic, None, qos=1, retain=retain)
-            mqtt_client.publish(self.exit_temp_sensor_discovery_topic, None, qos=1, retain=retain)
-            mqtt_client.publish(self.fumes_temp_sensor_discovery_topic, None, qos=1, retain=retain)
-            mqtt_client.publish(self.pellet_qty_sensor_discovery_topic, None, qos=1, retain=retain)
+            for topic in self.discovery_payloads:
+                self.house.publish(topic, None, qos=1, retain=retain, kind="discovery")
 
-    def on_message(self, topic, payload):
-        func = self.topic_to_func.get(topic, None)
-        if func is not None:
-            func(payload)
+    def on_commands_sent(self, success):
+        self.delayer.reset()
+        if success:
+            # Read back the new state right away instead of waiting for the next refresh
+            self.full_poll_requested = True
+            self.house.scheduler.schedule(self.hostname, 0)
+        else:
+            self.house.scheduler.schedule(self.hostname, self.delayer.next())
 
     def send_mode(self, payload):
-        self.house.palazzetti.set_power_state(self.hostname, payload == "heat")
+        return self.house.palazzetti.set_power_state(self.hostname, payload == "heat")
 
     def send_target_temperature(self, target_temperature):
-        if self.temp_step == 0.2:
-            self.house.palazzetti.set_float_target_temperature(self.hostname, target_temperature)
+        if self.house.config.temp_step == 0.2:
+            return self.house.palazzetti.set_float_target_temperature(self.hostname, target_temperature)
         else:
-            self.house.palazzetti.set_target_temperature(self.hostname, target_temperature)
+            # SETP only takes whole degrees
+            return self.house.palazzetti.set_target_temperature(self.hostname, int(round(float(target_temperature))))
 
     def send_fan_speed(self, fan_speed):
-        self.house.palazzetti.set_fan_speed(self.hostname, self.fanspd_val.get(fan_speed,"0"))
+        return self.house.palazzetti.set_fan_speed(self.hostname, self.fanspd_val.get(fan_speed,"0"))
 
     def send_power_level(self, power_level):
-        self.house.palazzetti.set_power_level(self.hostname, power_level)
+        return self.house.palazzetti.set_power_level(self.hostname, power_level)
 
     def send_timer(self, timer_state):
-        self.house.palazzetti.set_timer(self.hostname, timer_state)
+        return self.house.palazzetti.set_timer(self.hostname, timer_state)
 
-    def publish_state(self):
+    def apply_pellet_refill(self, quantity):
+        # Nothing to send to the box, the tank level is only known to the bridge
+        self.pellets.refill(quantity)
+
+    def publish_value(self, topic, value, retain, deadband=0):
+        if topic in self.published_values:
+            last_value = self.published_values[topic]
+            if value == last_value:
+                return
+            if deadband and value is not None and last_value is not None:
+                try:
+                    if abs(float(value) - float(last_value)) < deadband:
+                        return
+                except ValueError:
+                    pass
+        self.house.publish(topic, value, retain=retain)
+        self.published_values[topic] = value
+
+    def publish_state(self, force=False):
         mqtt_client = self.house.mqtt_client
         if mqtt_client is not None:
+            full_refresh = self.house.config.mqtt_state_full_refresh * 60
+            if force or time.time() - self.last_full_publish >= full_refresh:
+                self.published_values.clear()
+                self.last_full_publish = time.time()
             retain = self.house.config.mqtt_state_retain
-            mqtt_client.publish(self.climate_mqtt_config["current_temperature_topic"],
-                                self.room_temperature, retain=retain)
-            mqtt_client.publish(self.climate_mqtt_config["mode_state_topic"],
-                                self.mode, retain=retain)
-            mqtt_client.publish(self.climate_mqtt_config["temperature_state_topic"],
-                                self.target_temperature, retain=retain)
-            mqtt_client.publish(self.climate_mqtt_config["temp_step"],
-                                self.temp_step, retain=retain)
-            mqtt_client.publish(self.climate_mqtt_config["fan_mode_state_topic"],
-                                self.fan_speed, retain=retain)
-            mqtt_client.publish(self.climate_mqtt_config["hold_state_topic"],
-                                self.power_level, retain=retain)
-            mqtt_client.publish(self.climate_mqtt_config["swing_mode_state_topic"],
-                                self.timer_state, retain=retain)
-            mqtt_client.publish(self.climate_mqtt_config["availability_topic"],
-                                self.availability, retain=retain)
-            mqtt_client.publish(self.status_sensor_mqtt_config["state_topic"],
-                                self.status, retain=retain)
-            mqtt_client.publish(self.exit_temp_sensor_mqtt_config["state_topic"],
-                                self.exit_temperature, retain=retain)
-            mqtt_client.publish(self.fumes_temp_sensor_mqtt_config["state_topic"],
-                                self.fumes_temperature, retain=retain)
-            mqtt_client.publish(self.pellet_qty_sensor_mqtt_config["state_topic"],
-                                self.pellet_quantity, retain=retain)
+            deadband = self.house.config.mqtt_state_deadband
+            state = self.state
+            for field in STATE_FIELDS:
+                self.publish_value(self.state_topics[field.name], getattr(state, field.name), retain,
+                                   deadband if field.deadband else 0)
+            estimates = self.pellets.estimates(self.house.config.pellet_tank_capacity)
+            for name, topic in self.pellet_topics.items():
+                self.publish_value(topic, estimates[name], retain)
+            self.publish_availability(force)
+
+    def publish_availability(self, force=False):
+        # Published on transitions only (and when HA asks for everything again), not with every refresh
+        if force or self.availability != self.published_availability:
+            self.house.publish(self.availability_topic, self.availability, qos=1,
+                               retain=self.house.config.mqtt_state_retain, kind="availability")
+            self.published_availability = self.availability
+
+    def availability_expired(self):
+        logging.info("Device %s did not answer for %ss, now offline", self.device_id, self.house.config.offline_timeout)
+        self.availability = "offline"
+        if self.house.registered:
+            self.publish_availability()
+
+
+class DeviceState:
+    __slots__ = tuple(field.name for field in STATE_FIELDS)
+
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, None)
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def update(self, values):
+        for name in self.__slots__:
+            if name in values:
+                setattr(self, name, values[name])
 
 
 ################
@@ -328,13 +505,53 @@ class Config:
     mqtt_username = None
     mqtt_password = None
     mqtt_client_name = "cbox"
+    mqtt_bridge_availability_topic = "palazzetti/availability"
+    mqtt_buffer_size = 1000
     logging_level = "INFO"
     refresh_delays = [3, 5, 10, 30]
     refresh_delay_randomness = 2
     offline_timeout = 120
+    offline_refresh_delay = 300
+    transition_refresh_delay = 3
+    idle_refresh_delay = 120
+    idle_after = 600
+    mqtt_state_deadband = 0
+    mqtt_state_full_refresh = 10
+    api_connect_timeout = 2
+    api_read_timeout = 2
+    api_pool_size = 2
+    api_breaker_threshold = 3
+    api_breaker_cooldown = 30
+    poll_mode = "full"
+    full_poll_interval = 300
+    poll_concurrency = 8
+    poll_deadline = 5
+    command_concurrency = 4
+    command_queue_size = 100
+    command_ttl = 30
+    config_reload_interval = 5
+    history_window = 300
+    history_size = 1024
+    mqtt_history = True
+    history_file = None
+    history_file_max_bytes = 1048576
+    snapshot_file = "snapshot.json"
+    snapshot_interval = 60
+    shards = 1
+    shard_heartbeat_timeout = 300
+    metrics_host = "127.0.0.1"
+    metrics_port = None
+    state_api_host = "127.0.0.1"
+    state_api_port = None
+    state_api_proxy = False
+    state_api_proxy_max_age = 10
+    mqtt_stats_topic = None
+    stats_interval = 60
     temperature_unit = "°C"
     temp_step = 1
     pellet_quantity_unit = "kg"
+    pellet_tank_capacity = None
+    pellet_rate_smoothing = 0.3
 
     def __init__(self, raw):
         self.devices = raw.get("devices")
@@ -347,58 +564,232 @@ class Config:
         self.mqtt_discovery = raw.get("mqtt_discovery", self.mqtt_discovery)
         self.mqtt_config_retain = raw.get("mqtt_config_retain", self.mqtt_config_retain)
         self.mqtt_state_retain = raw.get("mqtt_state_retain", self.mqtt_state_retain)
+        self.mqtt_state_deadband = raw.get("mqtt_state_deadband", self.mqtt_state_deadband)
+        self.mqtt_state_full_refresh = raw.get("mqtt_state_full_refresh", self.mqtt_state_full_refresh)
         self.mqtt_username = raw.get("mqtt_username", self.mqtt_username)
         self.mqtt_password = raw.get("mqtt_password", self.mqtt_password)
         self.mqtt_client_name = raw.get("mqtt_client_name", self.mqtt_client_name)
+        self.mqtt_bridge_availability_topic = raw.get("mqtt_bridge_availability_topic",
+                                                      self.mqtt_bridge_availability_topic)
+        self.mqtt_buffer_size = raw.get("mqtt_buffer_size", self.mqtt_buffer_size)
         self.logging_level = raw.get("logging_level", self.logging_level)
         self.refresh_delays = raw.get("refresh_delays", self.refresh_delays)
         self.refresh_delay_randomness = raw.get("refresh_delay_randomness", self.refresh_delay_randomness)
         self.offline_timeout = raw.get("offline_timeout", self.offline_timeout)
+        self.offline_refresh_delay = raw.get("offline_refresh_delay", self.offline_refresh_delay)
+        self.transition_refresh_delay = raw.get("transition_refresh_delay", self.transition_refresh_delay)
+        self.idle_refresh_delay = raw.get("idle_refresh_delay", self.idle_refresh_delay)
+        self.idle_after = raw.get("idle_after", self.idle_after)
+        self.api_connect_timeout = raw.get("api_connect_timeout", self.api_connect_timeout)
+        self.api_read_timeout = raw.get("api_read_timeout", self.api_read_timeout)
+        self.api_pool_size = raw.get("api_pool_size", self.api_pool_size)
+        self.api_breaker_threshold = raw.get("api_breaker_threshold", self.api_breaker_threshold)
+        self.api_breaker_cooldown = raw.get("api_breaker_cooldown", self.api_breaker_cooldown)
+        self.poll_mode = raw.get("poll_mode", self.poll_mode)
+        self.full_poll_interval = raw.get("full_poll_interval", self.full_poll_interval)
+        self.poll_concurrency = raw.get("poll_concurrency", self.poll_concurrency)
+        self.poll_deadline = raw.get("poll_deadline", self.poll_deadline)
+        self.command_concurrency = raw.get("command_concurrency", self.command_concurrency)
+        self.command_queue_size = raw.get("command_queue_size", self.command_queue_size)
+        self.command_ttl = raw.get("command_ttl", self.command_ttl)
+        self.config_reload_interval = raw.get("config_reload_interval", self.config_reload_interval)
+        self.history_window = raw.get("history_window", self.history_window)
+        self.history_size = raw.get("history_size", self.history_size)
+        self.mqtt_history = raw.get("mqtt_history", self.mqtt_history)
+        self.history_file = raw.get("history_file", self.history_file)
+        self.history_file_max_bytes = raw.get("history_file_max_bytes", self.history_file_max_bytes)
+        self.snapshot_file = raw.get("snapshot_file", self.snapshot_file)
+        self.snapshot_interval = raw.get("snapshot_interval", self.snapshot_interval)
+        self.shards = raw.get("shards", self.shards)
+        self.shard_heartbeat_timeout = raw.get("shard_heartbeat_timeout", self.shard_heartbeat_timeout)
+        self.metrics_host = raw.get("metrics_host", self.metrics_host)
+        self.metrics_port = raw.get("metrics_port", self.metrics_port)
+        self.state_api_host = raw.get("state_api_host", self.state_api_host)
+        self.state_api_port = raw.get("state_api_port", self.state_api_port)
+        self.state_api_proxy = raw.get("state_api_proxy", self.state_api_proxy)
+        self.state_api_proxy_max_age = raw.get("state_api_proxy_max_age", self.state_api_proxy_max_age)
+        self.mqtt_stats_topic = raw.get("mqtt_stats_topic", self.mqtt_stats_topic)
+        self.stats_interval = raw.get("stats_interval", self.stats_interval)
         self.temperature_unit = raw.get("temperature_unit",self.temperature_unit)
         self.temp_step = raw.get("temp_step",self.temp_step)
         self.pellet_quantity_unit = raw.get("pellet_quantity_unit", self.pellet_quantity_unit)
+        self.pellet_tank_capacity = raw.get("pellet_tank_capacity", self.pellet_tank_capacity)
+        self.pellet_rate_smoothing = raw.get("pellet_rate_smoothing", self.pellet_rate_smoothing)
 
 
 ################ 
 
-class PalazzettiAdapter:
-    last_successful_response = 0
+class HostTransport:
+    def __init__(self, hostname, config):
+        self.hostname = hostname
+        import requests
+        import requests.adapters
 
-    def __init__(self):
-        self.delayer = Delayer([1], 2)
+        self.base_url = "http://{}".format(hostname)
         self.session = requests.Session()
+        # One pool per box, kept alive between polls; retries are handled by PalazzettiAdapter
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=config.api_pool_size, max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.headers["Connection"] = "keep-alive"
+        self.breaker_threshold = config.api_breaker_threshold
+        self.breaker_cooldown = config.api_breaker_cooldown
+        self.lock = threading.Lock()
+        self.consecutive_failures = 0
+        self.open_until = 0
+        self.probe_started = None
+        self.requests = 0
+        self.failures = 0
+        self.rejected = 0
+        self.latency_total = 0
+        self.last_latency = None
+
+    def allow_request(self):
+        # Once the circuit is open, a single request is let through after the cooldown to probe the box, the others
+        # are rejected until it succeeds (circuit closed) or fails (open for another cooldown)
+        with self.lock:
+            now = time.time()
+            if self.open_until == 0:
+                return True
+            # A probe that never reported back does not block the box forever
+            if now >= self.open_until and (self.probe_started is None
+                                           or now - self.probe_started >= self.breaker_cooldown):
+                self.probe_started = now
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self, latency):
+        with self.lock:
+            self.requests += 1
+            self.latency_total += latency
+            self.last_latency = latency
+            self.consecutive_failures = 0
+            self.open_until = 0
+            self.probe_started = None
+
+    def record_failure(self):
+        with self.lock:
+            self.requests += 1
+            self.failures += 1
+            self.consecutive_failures += 1
+            if self.consecutive_failures >= self.breaker_threshold:
+                if self.open_until == 0:
+                    logging.warning("Box %s failed %s times in a row, pausing calls for %ss", self.hostname,
+                                    self.consecutive_failures, self.breaker_cooldown)
+                self.open_until = time.time() + self.breaker_cooldown
+                self.probe_started = None
+
+    def stats(self):
+        with self.lock:
+            successes = self.requests - self.failures
+            return {
+                "requests": self.requests,
+                "failures": self.failures,
+                "rejected": self.rejected,
+                "consecutive_failures": self.consecutive_failures,
+                "circuit_open": time.time() < self.open_until,
+                "last_latency": self.last_latency,
+                "average_latency": self.latency_total / successes if successes else None
+            }
 
-    def get_api(self, url, retry=1):
-        logging.debug("API call: %s", url)
-        try:
-            response = self.session.get(url=url, data=None, headers=None, timeout=(2, 2))
-        except Exception as e:
-            logging.warning(e)
-            response = None
 
-        if response is None:
-            status_code = -1
-        else:
-            status_code = response.status_code
+class PalazzettiAdapter:
+    last_successful_response = 0
 
-        if status_code != 200:
-            if retry > 0:
-                logging.debug("API call failed with status code %s. Retrying.", status_code)
-                time.sleep(self.delayer.next())
-                return self.get_api(url, retry - 1)
-            else:
-                logging.debug("API call failed with status code %s. No more retry.", status_code)
-                return {}
-        else:
-            logging.debug("API response: %s", response.text)
+    def __init__(self, config, metrics=None):
+        self.config = config
+        self.metrics = metrics if metrics is not None else Metrics(False)
+        self.delayer = Delayer([1], 2)
+        self.transports = {}
+        self.transports_lock = threading.Lock()
+
+    def transport(self, hostname):
+        transport = self.transports.get(hostname, None)
+        if transport is None:
+            with self.transports_lock:
+                transport = self.transports.get(hostname, None)
+                if transport is None:
+                    transport = HostTransport(hostname, self.config)
+                    self.transports[hostname] = transport
+        return transport
+
+    def get_api(self, transport, path, retry=1, deadline=None):
+        import requests
+
+        url = transport.base_url + path
+        for attempt in range(retry + 1):
+            if attempt > 0:
+                delay = self.delayer.next()
+                if deadline is not None and time.time() + delay >= deadline:
+                    logging.debug("API call failed. No time left to retry before the deadline.")
+                    break
+                logging.debug("API call failed. Retrying.")
+                self.metrics.inc("api_retries_total", transport.hostname)
+                time.sleep(delay)
+            if not transport.allow_request():
+                logging.debug("API call to %s skipped, the box is not responding", transport.hostname)
+                break
+
+            logging.debug("API call: %s", url)
+            timeout = (self.config.api_connect_timeout, self.config.api_read_timeout)
+            if deadline is not None:
+                remaining = max(deadline - time.time(), 0.1)
+                timeout = (min(timeout[0], remaining), min(timeout[1], remaining))
+            start = time.time()
+            try:
+                response = transport.session.get(url=url, timeout=timeout)
+            except requests.RequestException as e:
+                logging.warning("API call to %s failed: %s", transport.hostname, e)
+                transport.record_failure()
+                self.metrics.inc("api_failures_total", transport.hostname)
+                continue
+
+            if response.status_code != 200:
+                logging.debug("API call failed with status code %s.", response.status_code)
+                transport.record_failure()
+                self.metrics.inc("api_failures_total", transport.hostname)
+                continue
+            # Decode the raw bytes directly, without building the intermediate text
+            logging.debug("API response: %s", response.content)
+            try:
+                data = json_loads(response.content)
+            except ValueError as e:
+                logging.warning("API call to %s returned an invalid payload: %s", transport.hostname, e)
+                transport.record_failure()
+                self.metrics.inc("api_failures_total", transport.hostname)
+                continue
+            latency = time.time() - start
+            transport.record_success(latency)
+            self.metrics.observe("api_request_seconds", latency, transport.hostname)
             self.last_successful_response = time.time()
-            return json.loads(response.text)
-
-    def send_command(self, hostname, command):
-        return self.get_api("http://{}/cgi-bin/sendmsg.lua?cmd={}".format(hostname, command))
-
-    def fetch_state(self, hostname):
-        return self.send_command(hostname, "GET ALLS")
+            return data
+        return {}
+
+    def send_command(self, hostname, command, deadline=None):
+        return self.get_api(self.transport(hostname), "/cgi-bin/sendmsg.lua?cmd={}".format(command), deadline=deadline)
+
+    def stats(self):
+        return {hostname: transport.stats() for hostname, transport in list(self.transports.items())}
+
+    def fetch_state(self, hostname, deadline=None):
+        response = self.send_command(hostname, "GET ALLS", deadline)
+        data = response.get("DATA", None)
+        if not isinstance(data, dict):
+            return response
+        if self.config.state_api_proxy:
+            # The GET ALLS proxy answers with the whole payload
+            return {"DATA": data}
+        # Only keep what Device.update_state reads, the rest of the (large) payload is dropped right away
+        return {"DATA": {key: data[key] for key in STATE_KEYS if key in data}}
+
+    def fetch_fast_state(self, hostname, deadline=None):
+        # Temperatures and status only, from commands that are much lighter than GET ALLS for the box
+        state = {}
+        for command in ("GET TMPS", "GET STAT"):
+            data = self.send_command(hostname, command, deadline).get("DATA", None)
+            if isinstance(data, dict):
+                state.update((key, data[key]) for key in STATE_KEYS if key in data)
+        return {"DATA": state} if state else {}
 
     def set_power_state(self, hostname, power_state):
         return self.send_command(hostname, "CMD {}".format(("ON", "OFF")[power_state]))
@@ -424,6 +815,196 @@ class PalazzettiAdapter:
 
 ################
 
+class History:
+    # Values kept for trend analysis, as Device state attribute names
+    fields = ("room_temperature", "exit_temperature", "fumes_temperature", "pellet_quantity", "power_level")
+
+    def __init__(self, size, window):
+        # Fixed size ring buffers of raw samples, plus the running min/max/sum of the current window
+        self.size = size
+        self.window = window
+        self.times = array("d", [0.0]) * size
+        self.values = [array("d", [float("nan")]) * size for _ in self.fields]
+        self.count = 0
+        self.window_start = None
+        self.window_samples = 0
+        self.window_min = [float("inf")] * len(self.fields)
+        self.window_max = [float("-inf")] * len(self.fields)
+        self.window_sum = [0.0] * len(self.fields)
+        self.window_count = [0] * len(self.fields)
+
+    def add(self, timestamp, values):
+        # Returns the aggregate of the previous window when this sample starts a new one
+        aggregate = None
+        window_start = timestamp - timestamp % self.window
+        if self.window_start is None:
+            self.window_start = window_start
+        elif window_start != self.window_start:
+            aggregate = self.aggregate()
+            self.window_start = window_start
+            self.window_samples = 0
+            for i in range(len(self.fields)):
+                self.window_min[i] = float("inf")
+                self.window_max[i] = float("-inf")
+                self.window_sum[i] = 0.0
+                self.window_count[i] = 0
+
+        index = self.count % self.size
+        self.times[index] = timestamp
+        self.count += 1
+        self.window_samples += 1
+        for i, value in enumerate(values):
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                value = float("nan")
+            self.values[i][index] = value
+            if value == value:
+                self.window_min[i] = min(self.window_min[i], value)
+                self.window_max[i] = max(self.window_max[i], value)
+                self.window_sum[i] += value
+                self.window_count[i] += 1
+        return aggregate
+
+    def aggregate(self):
+        aggregate = {"start": self.window_start, "end": self.window_start + self.window, "samples": self.window_samples}
+        for i, name in enumerate(self.fields):
+            if self.window_count[i]:
+                aggregate[name] = {"min": self.window_min[i], "max": self.window_max[i],
+                                   "mean": self.window_sum[i] / self.window_count[i]}
+            else:
+                aggregate[name] = None
+        return aggregate
+
+    def samples(self):
+        # Raw samples still in the buffers, oldest first, as (timestamp, [values])
+        first = max(self.count - self.size, 0)
+        return [(self.times[n % self.size], [values[n % self.size] for values in self.values])
+                for n in range(first, self.count)]
+
+
+class PelletEstimator:
+    # Name of each estimate, its state topic suffix, sensor name and unit (formatted with the pellet quantity unit)
+    sensors = (
+        ("rate", "pellet_rate", "pellet consumption", "{}/h"),
+        ("burned", "pellet_burned", "pellet burned", "{}"),
+        ("hours_left", "pellet_hours_left", "pellet hours left", "h"),
+    )
+
+    def __init__(self, smoothing):
+        # PQT is the pellet quantity burned by the stove, it only grows (by steps of 0.1 kg) while it is heating.
+        # The burn rate of each power level is learned from the time between two steps at that level.
+        self.smoothing = smoothing
+        # Polls update it from the poll threads, refills come from the MQTT thread
+        self.lock = threading.Lock()
+        self.last_quantity = None
+        self.burned = 0.0
+        self.rates = {}
+        self.heating = False
+        self.power_level = None
+        self.segment = None
+        self.segment_aligned = False
+
+    def add(self, timestamp, quantity, power_level, heating):
+        with self.lock:
+            if quantity is None:
+                return
+            if self.last_quantity is None or quantity < self.last_quantity:
+                # First sample, or the counter went back (box reset or replaced): start again from there
+                self.last_quantity = quantity
+                self.segment = None
+                return
+
+            delta = quantity - self.last_quantity
+            self.burned += delta
+            self.last_quantity = quantity
+
+            if not heating or power_level != self.power_level or self.segment is None:
+                # A measure only makes sense at a steady power level, start a new one
+                self.heating = heating
+                self.power_level = power_level
+                self.segment = (timestamp, quantity) if heating else None
+                self.segment_aligned = False
+                return
+            if delta <= 0:
+                return
+            segment_time, segment_quantity = self.segment
+            self.segment = (timestamp, quantity)
+            if not self.segment_aligned:
+                # The measure started somewhere between two steps, it is only accurate from the first step on
+                self.segment_aligned = True
+                return
+            if timestamp <= segment_time:
+                return
+            rate = (quantity - segment_quantity) * 3600 / (timestamp - segment_time)
+            key = str(power_level)
+            last_rate = self.rates.get(key, None)
+            self.rates[key] = rate if last_rate is None else last_rate + self.smoothing * (rate - last_rate)
+
+    def refill(self, quantity):
+        with self.lock:
+            # The tank was filled up, or quantity was poured in
+            if quantity is None:
+                self.burned = 0.0
+            else:
+                self.burned = max(self.burned - quantity, 0.0)
+
+    def estimates(self, capacity):
+        with self.lock:
+            learned_rate = self.rates.get(str(self.power_level), None)
+            rate = learned_rate if self.heating else 0
+            hours_left = None
+            if capacity is not None and learned_rate:
+                # At the burn rate of the current power level, whether the stove is heating right now or not
+                hours_left = round(max(capacity - self.burned, 0) / learned_rate, 1)
+            return {
+                "rate": None if rate is None else round(rate, 2),
+                "burned": round(self.burned, 1),
+                "hours_left": hours_left
+            }
+
+    def as_dict(self):
+        with self.lock:
+            return {"last_quantity": self.last_quantity, "burned": self.burned, "rates": dict(self.rates)}
+
+    def restore(self, saved):
+        with self.lock:
+            self.last_quantity = saved.get("last_quantity", None)
+            self.burned = saved.get("burned", 0.0)
+            self.rates = saved.get("rates", {})
+
+
+class HistoryLog:
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.header = ["device_id", "start", "end", "samples"] + [
+            "{}_{}".format(name, aggregate) for name in History.fields for aggregate in ("min", "max", "mean")]
+
+    def append(self, device_id, aggregate):
+        row = [device_id, int(aggregate["start"]), int(aggregate["end"]), aggregate["samples"]]
+        for name in History.fields:
+            values = aggregate[name]
+            row += ["", "", ""] if values is None else [
+                round(values["min"], 2), round(values["max"], 2), round(values["mean"], 2)]
+        with self.lock:
+            try:
+                # Keeps at most two files (the current one and .1), each up to max_bytes
+                if os.path.exists(self.path) and os.path.getsize(self.path) >= self.max_bytes:
+                    os.replace(self.path, self.path + ".1")
+                new_file = not os.path.exists(self.path)
+                with open(self.path, 'a', encoding="utf-8", newline="") as log_file:
+                    writer = csv.writer(log_file)
+                    if new_file:
+                        writer.writerow(self.header)
+                    writer.writerow(row)
+            except OSError as e:
+                logging.warning("Could not write the history file %s: %s", self.path, e)
+
+
+################
+
 class Delayer:
     def __init__(self, delays, randomness):
         self.delays = delays
@@ -433,6 +1014,10 @@ class Delayer:
     def reset(self):
         self.delay_index = 0
 
+    def settled(self):
+        # True once all the short delays after a reset were used
+        return self.delay_index == len(self.delays) - 1
+
     def next(self):
         delay = self.delays[self.delay_index] + self.randomness * (random.random() - .5)
         self.delay_index = min(len(self.delays) - 1, self.delay_index + 1)
@@ -441,109 +1026,1235 @@ class Delayer:
 
 ################
 
-class House:
+class CommandQueue:
+    def __init__(self, device):
+        self.device = device
+        self.pending = OrderedDict()
+        self.lock = threading.Lock()
+        self.draining = False
+
+    def put(self, kind, func, value):
+        with self.lock:
+            if self.pending.pop(kind, None) is not None:
+                logging.debug("Command %s for %s superseded by value %s", kind, self.device.hostname, value)
+            self.pending[kind] = (func, value, time.time())
+            if self.draining:
+                return
+            self.draining = True
+        if not self.device.house.dispatcher.submit(self.drain):
+            with self.lock:
+                self.device.house.dispatcher.count_dropped(len(self.pending))
+                self.pending.clear()
+                self.draining = False
+
+    def drain(self):
+        # Only one drain runs per device at a time so commands reach the box in order
+        dispatcher = self.device.house.dispatcher
+        success = False
+        while True:
+            with self.lock:
+                if not self.pending:
+                    self.draining = False
+                    break
+                kind, (func, value, received) = self.pending.popitem(last=False)
+            self.device.house.metrics.observe("command_queue_seconds", time.time() - received)
+            if time.time() - received > self.device.house.config.command_ttl:
+                logging.warning("Command %s for %s expired before it could be sent", kind, self.device.hostname)
+                dispatcher.count_expired()
+                continue
+            try:
+                # The box answers rejected commands with HTTP 200 too, only SUCCESS tells them apart
+                response = func(value)
+                if isinstance(response, dict) and response.get("SUCCESS", False):
+                    success = True
+                else:
+                    logging.warning("Command %s for %s was not accepted by the box: %s", kind, self.device.hostname,
+                                    response)
+                    dispatcher.count_failed()
+            except Exception as e:
+                logging.error("Command %s for %s failed: %s", kind, self.device.hostname, e)
+                dispatcher.count_failed()
+        self.device.on_commands_sent(success)
+
+
+class CommandDispatcher:
+    def __init__(self, workers, max_pending):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="command")
+        self.max_pending = max_pending
+        self.lock = threading.Lock()
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.dispatched = 0
+        self.dropped = 0
+        self.expired = 0
+        self.failed = 0
+
+    def submit(self, func):
+        with self.lock:
+            if self.queue_depth >= self.max_pending:
+                logging.warning("Command queue is full (%s jobs), dropping command", self.queue_depth)
+                return False
+            self.queue_depth += 1
+            self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+        self.executor.submit(self.run, func)
+        return True
+
+    def run(self, func):
+        try:
+            func()
+        except Exception as e:
+            logging.error("Command job failed: %s", e)
+        finally:
+            with self.lock:
+                self.queue_depth -= 1
+                self.dispatched += 1
+
+    def count_dropped(self, count=1):
+        with self.lock:
+            self.dropped += count
+
+    def count_expired(self):
+        with self.lock:
+            self.expired += 1
+
+    def count_failed(self):
+        with self.lock:
+            self.failed += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "queue_depth": self.queue_depth,
+                "max_queue_depth": self.max_queue_depth,
+                "dispatched": self.dispatched,
+                "dropped": self.dropped,
+                "expired": self.expired,
+                "failed": self.failed
+            }
+
+
+################
+
+class MqttPublisher:
+    # Outbound stage between the house and the paho client. While the broker is unreachable (or paho's queue is
+    # full), messages wait in a bounded buffer that only keeps the latest payload of each topic, and are sent once
+    # connected again, after the subscriptions are restored.
+
+    # paho.mqtt.client.MQTT_ERR_NO_CONN, paho itself keeps QoS 1 and 2 messages published with this result and sends
+    # them again on reconnection
+    rc_no_connection = 4
+
+    def __init__(self, client, buffer_size, connected):
+        self.client = client
+        self.buffer_size = buffer_size
+        # Held while sending too, so that direct publishes and flushes never reorder the payloads of a topic
+        self.lock = threading.RLock()
+        self.connected = connected
+        self.buffer = OrderedDict()
+        self.subscriptions = {}
+        self.published = 0
+        self.buffered = 0
+        self.superseded = 0
+        self.dropped = 0
+        self.failed = 0
+        self.max_buffer_depth = 0
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        with self.lock:
+            # Behind held messages, so that an older payload of the same topic is never sent after this one.
+            # Nothing goes to paho while disconnected, or it would replay every stale QoS 1 payload on reconnection.
+            if self.connected and not self.buffer:
+                result = self.send(topic, payload, qos, retain)
+                if result is not None:
+                    return result
+            self.hold(topic, (payload, qos, retain))
+            if self.connected:
+                self.flush()
+        return None
+
+    def send(self, topic, payload, qos, retain):
+        result = self.client.publish(topic, payload, qos=qos, retain=retain)
+        # paho returns a MQTTMessageInfo, stand-in clients may return nothing
+        rc = getattr(result, "rc", 0)
+        if rc == 0 or (rc == self.rc_no_connection and qos > 0):
+            self.published += 1
+            return result if result is not None else True
+        self.failed += 1
+        logging.debug("MQTT publish on %s failed with rc %s, holding it", topic, rc)
+        return None
+
+    def hold(self, topic, message):
+        with self.lock:
+            if self.buffer.pop(topic, None) is not None:
+                self.superseded += 1
+            self.buffer[topic] = message
+            self.buffered += 1
+            while len(self.buffer) > self.buffer_size:
+                self.buffer.popitem(last=False)
+                self.dropped += 1
+            self.max_buffer_depth = max(self.max_buffer_depth, len(self.buffer))
+
+    def subscribe(self, topic, qos=0):
+        with self.lock:
+            self.subscriptions[topic] = qos
+        if self.connected:
+            self.client.subscribe(topic, qos)
+
+    def unsubscribe(self, topic):
+        with self.lock:
+            self.subscriptions.pop(topic, None)
+        if self.connected:
+            self.client.unsubscribe(topic)
+
+    def on_connect(self):
+        # Subscriptions are lost with the session, restore them before anything that could trigger a command
+        with self.lock:
+            self.connected = True
+            subscriptions = list(self.subscriptions.items())
+        for topic, qos in subscriptions:
+            self.client.subscribe(topic, qos)
+        self.flush()
+
+    def on_disconnect(self):
+        self.connected = False
+
+    def flush(self):
+        with self.lock:
+            while self.connected and self.buffer:
+                topic, (payload, qos, retain) = self.buffer.popitem(last=False)
+                if self.send(topic, payload, qos, retain) is None:
+                    # Still failing (paho's queue is full): back in front, try again with the next publish
+                    self.buffer[topic] = (payload, qos, retain)
+                    self.buffer.move_to_end(topic, last=False)
+                    return
+
+    def stats(self):
+        with self.lock:
+            return {
+                "connected": int(self.connected),
+                "buffer_depth": len(self.buffer),
+                "max_buffer_depth": self.max_buffer_depth,
+                "published": self.published,
+                "buffered": self.buffered,
+                "superseded": self.superseded,
+                "dropped": self.dropped,
+                "failed": self.failed
+            }
+
+
+################
+
+class Scheduler:
+    def __init__(self):
+        self.queue = []
+        self.due_times = {}
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+
+    def schedule(self, key, delay):
+        due_time = time.time() + max(delay, 0)
+        with self.lock:
+            self.due_times[key] = due_time
+            heapq.heappush(self.queue, (due_time, next(self.counter), key))
+        self.wakeup.set()
+
+    def remove(self, key):
+        with self.lock:
+            self.due_times.pop(key, None)
+
+    def pop_due(self):
+        now = time.time()
+        due_keys = []
+        with self.lock:
+            while self.queue and self.queue[0][0] <= now:
+                due_time, _, key = heapq.heappop(self.queue)
+                # Entries that were rescheduled or removed since they were pushed are stale
+                if self.due_times.get(key) == due_time:
+                    del self.due_times[key]
+                    due_keys.append(key)
+        return due_keys
+
+    def wait(self, max_timeout=None):
+        with self.lock:
+            timeout = self.queue[0][0] - time.time() if self.queue else None
+            self.wakeup.clear()
+        if max_timeout is not None and (timeout is None or timeout > max_timeout):
+            timeout = max_timeout
+        if timeout is None or timeout > 0:
+            self.wakeup.wait(timeout)
+
+
+################
+
+class Histogram:
+    bounds = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
     def __init__(self):
-        self.config = self.read_config()
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.total = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.total += value
+        self.count += 1
+
+
+class Metrics:
+    # name: (type, help, label name)
+    definitions = {
+        "api_request_seconds": ("histogram", "Duration of the successful HTTP calls to a box", "host"),
+        "api_retries_total": ("counter", "HTTP calls to a box that were retried", "host"),
+        "api_failures_total": ("counter", "HTTP calls to a box that failed", "host"),
+        "poll_seconds": ("histogram", "Duration of a device poll, retries included", "host"),
+        "cycle_seconds": ("histogram", "Duration of a refresh cycle", None),
+        "mqtt_messages_total": ("counter", "MQTT messages published", "kind"),
+        "mqtt_bytes_total": ("counter", "Payload bytes published on MQTT", "kind"),
+        "commands_received_total": ("counter", "Commands received on MQTT", None),
+        "commands_rejected_total": ("counter", "Commands rejected because of their topic or payload", None),
+        "command_queue_seconds": ("histogram", "Time a command waited before being sent to its box", None),
+    }
+
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.series = {name: {} for name in self.definitions}
+        self.collectors = []
+
+    def inc(self, name, label=None, value=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            series = self.series[name]
+            series[label] = series.get(label, 0) + value
+
+    def observe(self, name, value, label=None):
+        if not self.enabled:
+            return
+        with self.lock:
+            series = self.series[name]
+            histogram = series.get(label, None)
+            if histogram is None:
+                histogram = series[label] = Histogram()
+            histogram.observe(value)
+
+    def add_collector(self, collector):
+        # Collectors are called when the metrics are read and return {name: (help, label name, {label: value})}
+        self.collectors.append(collector)
+
+    def collect(self):
+        gauges = {}
+        for collector in self.collectors:
+            gauges.update(collector())
+        return gauges
+
+    @staticmethod
+    def label_key(label):
+        return "all" if label is None else str(label)
+
+    def snapshot(self):
+        snapshot = {}
+        with self.lock:
+            for name, series in self.series.items():
+                if self.definitions[name][0] == "histogram":
+                    snapshot[name] = {self.label_key(label): {"count": histogram.count, "sum": histogram.total}
+                                      for label, histogram in series.items()}
+                else:
+                    snapshot[name] = {self.label_key(label): value for label, value in series.items()}
+        for name, (_, _, values) in self.collect().items():
+            snapshot[name] = {self.label_key(label): value for label, value in values.items()}
+        return snapshot
+
+    @staticmethod
+    def labels(label_name, label, extra=""):
+        if label_name is None or label is None:
+            return "{" + extra + "}" if extra else ""
+        pair = '{}="{}"'.format(label_name, str(label).replace("\\", "\\\\").replace('"', '\\"'))
+        return "{" + pair + ("," + extra if extra else "") + "}"
+
+    def render_prometheus(self):
+        lines = []
+        with self.lock:
+            for name, series in self.series.items():
+                metric_type, help_text, label_name = self.definitions[name]
+                lines.append("# HELP cbox_{} {}".format(name, help_text))
+                lines.append("# TYPE cbox_{} {}".format(name, metric_type))
+                for label, value in series.items():
+                    if metric_type != "histogram":
+                        lines.append("cbox_{}{} {}".format(name, self.labels(label_name, label), value))
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(value.bounds + ("+Inf",), value.counts):
+                        cumulative += count
+                        lines.append("cbox_{}_bucket{} {}".format(
+                            name, self.labels(label_name, label, 'le="{}"'.format(bound)), cumulative))
+                    lines.append("cbox_{}_sum{} {}".format(name, self.labels(label_name, label), value.total))
+                    lines.append("cbox_{}_count{} {}".format(name, self.labels(label_name, label), value.count))
+        for name, (help_text, label_name, values) in self.collect().items():
+            lines.append("# HELP cbox_{} {}".format(name, help_text))
+            lines.append("# TYPE cbox_{} gauge".format(name))
+            for label, value in values.items():
+                if value is not None:
+                    lines.append("cbox_{}{} {}".format(name, self.labels(label_name, label), float(value)))
+        return "\n".join(lines) + "\n"
+
+
+class HttpRequestHandler:
+    # Mixed with http.server's BaseHTTPRequestHandler by HttpEndpoint, which imports it only when needed
+
+    def do_GET(self):
+        path = self.path.split("?", 1)[0]
+        route = self.server.routes.get(path, None)
+        if route is None and path.find("/", 1) > 0:
+            # Routes ending with a slash also serve everything below them
+            route = self.server.routes.get(path[:path.find("/", 1) + 1], None)
+        if route is None:
+            status_code, headers, body = 404, {"Content-Type": "text/plain"}, b"Not found\n"
+        else:
+            status_code, headers, body = route(self)
+        self.send_response(status_code)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug("HTTP %s - " + format, self.address_string(), *args)
+
+
+class HttpEndpoint:
+    def __init__(self, host, port):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        handler = type("HttpRequestHandler", (HttpRequestHandler, BaseHTTPRequestHandler), {})
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+        self.server.routes = {}
+
+    def add_route(self, path, route):
+        # A route takes the request handler and returns (status code, headers, body bytes). A path ending with a
+        # slash is a prefix for the paths with one more level, e.g. "/devices/" serves "/devices/<id>".
+        self.server.routes[path] = route
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name="http", daemon=True).start()
+        logging.info("HTTP endpoint listening on %s:%s", *self.server.server_address[:2])
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+################
+
+def paho_client_options(mqtt):
+    # paho-mqtt 2 refuses to build a client without a callback API version, the callbacks here use the 1.x signatures
+    version = getattr(mqtt, "CallbackAPIVersion", None)
+    return {} if version is None else {"callback_api_version": version.VERSION1}
+
+
+class House:
+    # Settings that are only read when the bridge starts
+    restart_settings = ("mqtt_host", "mqtt_port", "mqtt_username", "mqtt_password", "mqtt_client_name",
+                        "mqtt_bridge_availability_topic", "mqtt_buffer_size",
+                        "logging_level", "api_pool_size", "api_breaker_threshold", "api_breaker_cooldown",
+                        "poll_concurrency", "command_concurrency", "command_queue_size", "shards", "metrics_host",
+                        "metrics_port", "history_window", "history_size", "history_file", "history_file_max_bytes",
+                        "pellet_rate_smoothing", "state_api_host", "state_api_port", "state_api_proxy",
+                        "config_reload_interval")
+
+    def __init__(self, config=None, mqtt_client=None):
+        # Only a config read from the files can be reloaded when they change
+        self.config_file_mtimes = self.config_mtimes() if config is None else None
+        self.config = config if config is not None else self.read_config()
         logging.basicConfig(level=self.config.logging_level, format="%(asctime)-15s %(levelname)-8s %(message)s")
-        self.mqtt_client = mqtt.Client(self.config.mqtt_client_name)
-        if self.config.mqtt_username is not None:
-            self.mqtt_client.username_pw_set(self.config.mqtt_username, self.config.mqtt_password)
-        self.mqtt_client.connect(self.config.mqtt_host, self.config.mqtt_port)
+        if mqtt_client is None:
+            import paho.mqtt.client as mqtt
+
+            mqtt_client = mqtt.Client(client_id=self.config.mqtt_client_name, **paho_client_options(mqtt))
+            if self.config.mqtt_username is not None:
+                mqtt_client.username_pw_set(self.config.mqtt_username, self.config.mqtt_password)
+            # The broker tells HA that every device is unavailable when the bridge goes away without a word
+            mqtt_client.will_set(self.config.mqtt_bridge_availability_topic, "offline", qos=1, retain=True)
+            # Bounded, the overflow goes to the publisher buffer
+            mqtt_client.max_queued_messages_set(self.config.mqtt_buffer_size)
+            mqtt_client.on_connect = self.on_connect
+            mqtt_client.on_disconnect = self.on_disconnect
+            mqtt_client.connect(self.config.mqtt_host, self.config.mqtt_port)
+            # Nothing is sent before the broker accepts the connection
+            self.publisher = MqttPublisher(mqtt_client, self.config.mqtt_buffer_size, False)
+        else:
+            self.publisher = MqttPublisher(mqtt_client, self.config.mqtt_buffer_size, True)
+        self.mqtt_client = mqtt_client
+        self.running = False
+        self.heartbeat = None
         self.devices = {}
-        self.delayer = Delayer(self.config.refresh_delays, self.config.refresh_delay_randomness)
-        self.palazzetti = PalazzettiAdapter()
+        self.devices_by_hostname = {}
+        self.scheduler = Scheduler()
+        self.metrics = Metrics(self.config.metrics_port is not None or self.config.mqtt_stats_topic is not None)
+        self.metrics.add_collector(self.collect_gauges)
+        self.http_endpoints = {}
+        self.updated = threading.Condition()
+        self.history_log = None
+        if self.config.history_file is not None:
+            self.history_log = HistoryLog(self.config.history_file, self.config.history_file_max_bytes)
+        self.palazzetti = PalazzettiAdapter(self.config, self.metrics)
+        self.poll_executor = ThreadPoolExecutor(max_workers=self.config.poll_concurrency, thread_name_prefix="poll")
+        self.pending_polls = {}
+        self.dispatcher = CommandDispatcher(self.config.command_concurrency, self.config.command_queue_size)
+        self.reset_requested = False
+        self.routes = {}
+        self.stats_key = ("stats",)
+        self.config_key = ("config",)
+        self.snapshot_key = ("snapshot",)
+        self.registered = False
 
     @staticmethod
-    def read_config():
+    def read_raw_config():
+        import yaml
+
         with open("config/default.yml", 'r', encoding="utf-8") as yml_file:
             raw_default_config = yaml.safe_load(yml_file)
+        if not isinstance(raw_default_config, dict):
+            raise ValueError("config/default.yml does not hold a mapping of settings")
 
         try:
             with open("config/local.yml", 'r', encoding="utf-8") as yml_file:
                 raw_local_config = yaml.safe_load(yml_file)
-                raw_default_config.update(raw_local_config)
         except IOError:
             logging.info("No local config file found")
+        else:
+            # An empty file (e.g. while an editor rewrites it) loads as None
+            if not isinstance(raw_local_config, dict):
+                raise ValueError("config/local.yml does not hold a mapping of settings")
+            raw_default_config.update(raw_local_config)
+
+        devices = raw_default_config.get("devices")
+        if not isinstance(devices, list) or not all(
+                isinstance(device_cfg, dict) and "name" in device_cfg and "hostname" in device_cfg
+                for device_cfg in devices):
+            raise ValueError("devices must be a list of entries with a name and a hostname")
+        return raw_default_config
 
-        return Config(raw_default_config)
+    @staticmethod
+    def read_config():
+        return Config(House.read_raw_config())
 
     def register_all(self):
-        self.mqtt_client.loop_start()
-        self.mqtt_client.subscribe(self.config.mqtt_reset_topic, 0)
+        self.publish(self.config.mqtt_bridge_availability_topic, "online", qos=1, retain=True, kind="availability")
+        self.publisher.subscribe(self.config.mqtt_reset_topic, 0)
         for device_id, device in self.devices.items():
             device.register_mqtt()
         self.mqtt_client.on_message = self.on_message
+        self.registered = True
 
     def unregister_all(self):
-        self.mqtt_client.on_message(None)
-        self.mqtt_client.unsubscribe(self.config.mqtt_reset_topic, 0)
+        self.registered = False
+        self.mqtt_client.on_message = None
+        self.publisher.unsubscribe(self.config.mqtt_reset_topic)
         for device_id, device in self.devices.items():
             device.unregister_mqtt()
-        self.mqtt_client.loop_stop()
 
-    def update_all_states(self):
-        logging.debug("update_all_states: begin")
-        logging.debug("devices at beginning: %s", str(self.devices))
-        for device_cfg in self.config.devices:
-            logging.debug("update_all_states: %s begin", device_cfg["hostname"])
-            raw_device = self.palazzetti.fetch_state(device_cfg["hostname"])
-            logging.debug("update_all_states: raw_device %s", json.dumps(raw_device))
+    @staticmethod
+    def config_mtimes():
+        mtimes = []
+        for path in ("config/default.yml", "config/local.yml"):
             try:
-                device_id = raw_device["DATA"]["MAC"].replace(':', '_')
-            except KeyError:
-                logging.debug("Payload received: %s", json.dumps(raw_device))
-                logging.error("Device response payload is missing a MAC identifier")
-                return
-            logging.debug("update_all_states: device_id %s", device_id)
-            if device_id in self.devices:
-                device = self.devices[device_id]
+                mtimes.append(os.stat(path).st_mtime)
+            except OSError:
+                mtimes.append(None)
+        return tuple(mtimes)
+
+    def check_config(self):
+        import yaml
+
+        mtimes = self.config_mtimes()
+        if mtimes != self.config_file_mtimes:
+            self.config_file_mtimes = mtimes
+            try:
+                config = Config(self.read_raw_config())
+            except (OSError, ValueError, yaml.YAMLError) as e:
+                logging.error("Could not reload the config, keeping the current one: %s", e)
+            else:
+                logging.info("Config files changed, reloading")
+                try:
+                    self.apply_config(config)
+                except Exception:
+                    # The bridge keeps running with whatever part of the new config was applied
+                    logging.exception("Could not apply the new config")
+        if self.config.config_reload_interval:
+            self.scheduler.schedule(self.config_key, self.config.config_reload_interval)
+
+    def forget_device(self, device):
+        self.devices.pop(device.device_id, None)
+        self.devices_by_hostname.pop(device.hostname, None)
+        self.scheduler.remove(device.hostname)
+        self.scheduler.remove(device.availability_key)
+        self.pending_polls.pop(device.hostname, None)
+
+    def apply_config(self, config):
+        old_config = self.config
+        for name in self.restart_settings:
+            if getattr(old_config, name) != getattr(config, name):
+                logging.warning("Config %s changed, restart Cbox to apply it", name)
+                # Keep running with the current value, half applying it would be worse (e.g. discovery pointing at a
+                # bridge availability topic that is not the last will)
+                setattr(config, name, getattr(old_config, name))
+        old_device_cfgs = {device_cfg["hostname"]: device_cfg for device_cfg in old_config.devices}
+        device_cfgs = {device_cfg["hostname"]: device_cfg for device_cfg in config.devices}
+        discovery_changed = (old_config.mqtt_discovery != config.mqtt_discovery
+                             or old_config.mqtt_config_retain != config.mqtt_config_retain)
+
+        # Devices whose topics or discovery configs change are unregistered with the old config and registered again
+        # with the new one. The others keep their subscriptions and are not polled again.
+        changed_devices = []
+        for device in list(self.devices.values()):
+            device_cfg = device_cfgs.get(device.hostname, None)
+            if device_cfg is None:
+                logging.info("Device removed: %s (%s | %s)", device.name, device.device_id, device.hostname)
+                device.unregister_mqtt()
+                self.forget_device(device)
+            elif discovery_changed or device.current_mqtt_config_key(config, device_cfg["name"]) != device.mqtt_config_key:
+                device.unregister_mqtt()
+                changed_devices.append((device, device_cfg))
+        if old_config.mqtt_reset_topic != config.mqtt_reset_topic:
+            self.publisher.unsubscribe(old_config.mqtt_reset_topic)
+
+        self.config = config
+        self.palazzetti.config = config
+        if old_config.mqtt_reset_topic != config.mqtt_reset_topic:
+            self.publisher.subscribe(config.mqtt_reset_topic, 0)
+        for device in self.devices.values():
+            device.delayer.delays = config.refresh_delays
+            device.delayer.delay_index = min(device.delayer.delay_index, len(config.refresh_delays) - 1)
+            device.delayer.randomness = config.refresh_delay_randomness
+        for device, device_cfg in changed_devices:
+            device.name = device_cfg["name"]
+            device.update_mqtt_config()
+            device.register_mqtt()
+            device.publish_state(force=True)
+        for hostname in device_cfgs:
+            if hostname not in old_device_cfgs:
+                logging.info("Device added: %s", hostname)
+                self.scheduler.schedule(hostname, 0)
+
+    def publish(self, topic, payload, qos=0, retain=False, kind="state"):
+        if self.metrics.enabled:
+            self.metrics.inc("mqtt_messages_total", kind)
+            if payload is not None:
+                size = len(payload) if isinstance(payload, bytes) else len(str(payload).encode("utf-8"))
+                self.metrics.inc("mqtt_bytes_total", kind, size)
+        return self.publisher.publish(topic, payload, qos=qos, retain=retain)
+
+    def export_history(self, device, aggregate):
+        if self.config.mqtt_history:
+            self.publish(device.history_topic, json.dumps(aggregate), kind="history")
+        if self.history_log is not None:
+            self.history_log.append(device.device_id, aggregate)
+
+    def collect_gauges(self):
+        hosts = self.palazzetti.stats()
+        gauges = {
+            "api_circuit_open": ("1 when calls to the box are paused", "host",
+                                 {hostname: int(stats["circuit_open"]) for hostname, stats in hosts.items()}),
+            "api_last_latency_seconds": ("Duration of the last successful call to the box", "host",
+                                         {hostname: stats["last_latency"] for hostname, stats in hosts.items()}),
+        }
+        for name, value in self.dispatcher.stats().items():
+            gauges["command_" + name] = ("Command dispatcher " + name.replace("_", " "), None, {None: value})
+        for name, value in self.publisher.stats().items():
+            gauges["mqtt_publisher_" + name] = ("MQTT publisher " + name.replace("_", " "), None, {None: value})
+        return gauges
+
+    def http_endpoint(self, host, port):
+        # The metrics and the state API share one endpoint when they are on the same address
+        endpoint = self.http_endpoints.get((host, port), None)
+        if endpoint is None:
+            endpoint = HttpEndpoint(host, port)
+            endpoint.start()
+            self.http_endpoints[(host, port)] = endpoint
+        return endpoint
+
+    def start_stats(self):
+        if self.config.metrics_port is not None:
+            self.http_endpoint(self.config.metrics_host, self.config.metrics_port).add_route("/metrics", lambda request: (
+                200, {"Content-Type": "text/plain; version=0.0.4"}, self.metrics.render_prometheus().encode("utf-8")))
+        if self.config.mqtt_stats_topic is not None:
+            self.scheduler.schedule(self.stats_key, self.config.stats_interval)
+
+    def publish_stats(self):
+        self.publish(self.config.mqtt_stats_topic, json.dumps(self.metrics.snapshot()), kind="stats")
+        self.scheduler.schedule(self.stats_key, self.config.stats_interval)
+
+    def start_state_api(self):
+        if self.config.state_api_port is None:
+            return
+        endpoint = self.http_endpoint(self.config.state_api_host, self.config.state_api_port)
+        endpoint.add_route("/devices", self.serve_devices)
+        endpoint.add_route("/devices/", self.serve_devices)
+        if self.config.state_api_proxy:
+            endpoint.add_route("/boxes/", self.serve_box)
+
+    def device_view(self, device, now):
+        return {
+            "name": device.name,
+            "hostname": device.hostname,
+            "availability": device.availability,
+            "last_update": device.last_update,
+            "age": round(now - device.last_update, 1) if device.last_update else None,
+            "state": device.state.as_dict(),
+            "pellets": device.pellets.estimates(self.config.pellet_tank_capacity)
+        }
+
+    def serve_devices(self, request):
+        # What the bridge already knows, no box is called. The (weak) ETag only changes with the values, not with
+        # the update time or the age, so that consumers polling this often get a cheap 304.
+        path = request.path.split("?", 1)[0]
+        if path == "/devices":
+            # Runs on the HTTP threads while the main loop adds and removes devices
+            devices = sorted(list(self.devices.values()), key=lambda device: device.device_id)
+        else:
+            device_id, _, resource = path[len("/devices/"):].partition("/")
+            device = self.devices.get(device_id, None)
+            if device is None or resource not in ("", "history"):
+                return 404, {"Content-Type": "application/json"}, b'{"error": "unknown device"}'
+            if resource == "history":
+                return self.serve_history(device)
+            devices = [device]
+        capacity = self.config.pellet_tank_capacity
+        etag = 'W/"{:08x}"'.format(zlib.crc32(repr([
+            (device.device_id, device.name, device.availability, device.state.as_dict(),
+             device.pellets.estimates(capacity)) for device in devices]).encode("utf-8")))
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if request.headers.get("If-None-Match", None) == etag:
+            return 304, headers, b""
+        now = time.time()
+        if path == "/devices":
+            body = {"devices": {device.device_id: self.device_view(device, now) for device in devices}}
+        else:
+            body = self.device_view(devices[0], now)
+        headers["Content-Type"] = "application/json"
+        return 200, headers, json.dumps(body).encode("utf-8")
+
+    def serve_history(self, device):
+        # The raw samples of the history buffer, oldest first, missing values as null
+        if device.history is None:
+            return 404, {"Content-Type": "application/json"}, b'{"error": "history is disabled"}'
+        samples = [[timestamp] + [value if value == value else None for value in values]
+                   for timestamp, values in device.history.samples()]
+        body = {"fields": ["time"] + list(History.fields), "samples": samples}
+        return 200, {"Content-Type": "application/json", "Cache-Control": "no-cache"}, json.dumps(body).encode("utf-8")
+
+    def serve_box(self, request):
+        # /boxes/<hostname or device id>/cgi-bin/sendmsg.lua?cmd=GET ALLS, answered like the box would, from a
+        # payload at most state_api_proxy_max_age seconds old. Older ones are refreshed by a single poll shared by
+        # all the waiting consumers.
+        from urllib.parse import parse_qs, urlsplit
+
+        url = urlsplit(request.path)
+        # "/boxes/<name>/cgi-bin/sendmsg.lua" gives ["", "boxes", name, "cgi-bin/sendmsg.lua"]
+        parts = url.path.split("/", 3)
+        name = parts[2] if len(parts) == 4 else None
+        command = parse_qs(url.query).get("cmd", [""])[0]
+        device = self.devices_by_hostname.get(name, None) or self.devices.get(name, None)
+        headers = {"Content-Type": "application/json"}
+        if device is None or parts[3:] != ["cgi-bin/sendmsg.lua"]:
+            return 404, headers, json.dumps({"SUCCESS": False}).encode("utf-8")
+        if command.upper() != "GET ALLS":
+            # Commands go through MQTT, the proxy is read-only
+            return 403, headers, json.dumps({"INFO": {"CMD": command, "RSP": "ERROR"}, "SUCCESS": False,
+                                             "DATA": {}}).encode("utf-8")
+
+        max_age = self.config.state_api_proxy_max_age
+        if time.time() - device.last_full_update > max_age:
+            device.full_poll_requested = True
+            self.scheduler.schedule(device.hostname, 0)
+            deadline = time.time() + self.config.poll_deadline + 1
+            with self.updated:
+                while time.time() - device.last_full_update > max_age and time.time() < deadline:
+                    self.updated.wait(deadline - time.time())
+        if device.full_data is None or time.time() - device.last_full_update > max_age:
+            return 504, headers, json.dumps({"SUCCESS": False}).encode("utf-8")
+        return 200, headers, json.dumps({
+            "INFO": {"CMD": "GET ALLS", "RSP": "OK", "TS": int(device.last_full_update)},
+            "SUCCESS": True,
+            "DATA": device.full_data
+        }).encode("utf-8")
+
+    def poll_device(self, hostname):
+        # The deadline starts when a worker picks the device up, not when it was queued
+        start = time.time()
+        device = self.devices_by_hostname.get(hostname, None)
+        if (self.config.poll_mode == "tiered" and device is not None and not device.full_poll_requested
+                and start - device.last_full_update < self.config.full_poll_interval):
+            response = self.palazzetti.fetch_fast_state(hostname, start + self.config.poll_deadline)
+        else:
+            response = self.palazzetti.fetch_state(hostname, start + self.config.poll_deadline)
+        self.metrics.observe("poll_seconds", time.time() - start, hostname)
+        return response
+
+    def fetch_all_states(self, device_cfgs):
+        futures = []
+        for device_cfg in device_cfgs:
+            hostname = device_cfg["hostname"]
+            future = self.pending_polls.get(hostname)
+            if future is not None and not future.done():
+                logging.warning("Previous poll of %s is still running. Skipping it this cycle.", hostname)
+                continue
+            future = self.poll_executor.submit(self.poll_device, hostname)
+            self.pending_polls[hostname] = future
+            futures.append((device_cfg, future))
+
+        # Every device gets its own deadline, this is only a safety net for the whole batch
+        batches = -(-len(futures) // self.config.poll_concurrency)
+        wait([future for _, future in futures], timeout=batches * (self.config.poll_deadline + 1))
+
+        results = []
+        for device_cfg, future in futures:
+            if not future.done():
+                logging.warning("Device %s did not respond before its deadline", device_cfg["hostname"])
+                continue
+            try:
+                results.append((device_cfg, future.result()))
+            except Exception as e:
+                logging.warning("Polling %s failed: %s", device_cfg["hostname"], e)
+        return results
+
+    def update_states(self, device_cfgs):
+        start = time.time()
+        logging.debug("update_states: begin")
+        logging.debug("devices at beginning: %s", self.devices)
+        updated_devices = []
+        for device_cfg, raw_device in self.fetch_all_states(device_cfgs):
+            logging.debug("update_states: %s begin", device_cfg["hostname"])
+            logging.debug("update_states: raw_device %s", raw_device)
+            data = raw_device.get("DATA", None)
+            if not data:
+                logging.debug("Payload received: %s", raw_device)
+                logging.error("Device response payload from %s has no data", device_cfg["hostname"])
+                continue
+            full_update = "MAC" in data
+            if full_update:
+                device_id = data["MAC"].replace(':', '_')
+                logging.debug("update_states: device_id %s", device_id)
+                previous_device = self.devices_by_hostname.get(device_cfg["hostname"], None)
+                if previous_device is not None and previous_device.device_id != device_id:
+                    # Another box answers on this hostname now (replaced box, or stale snapshot)
+                    logging.info("Device %s replaced by %s on %s", previous_device.device_id, device_id,
+                                 previous_device.hostname)
+                    previous_device.unregister_mqtt()
+                    self.forget_device(previous_device)
+                if device_id in self.devices:
+                    device = self.devices[device_id]
+                else:
+                    device = Device(self, device_id,  device_cfg["name"], device_cfg["hostname"])
+                    self.devices[device.device_id] = device
+                    device.update_mqtt_config()
+                    if self.registered:
+                        # Found after startup (late box or added to the config): register it on its own
+                        logging.info("Device found: %s (%s | %s)", device.name, device.device_id, device.hostname)
+                        device.register_mqtt()
+                self.devices_by_hostname[device.hostname] = device
             else:
-                device = Device(self, device_id,  device_cfg["name"], device_cfg["hostname"])
-                self.devices[device.device_id] = device
-            logging.debug("device before update: %s", str(device))
-            device.update_state(raw_device["DATA"])
-            logging.debug("device after update: %s", str(device))
-        logging.debug("devices at end: %s", str(self.devices))
-        logging.debug("update_all_states: end")
+                # Partial responses (tiered polling) do not carry the MAC, the device is known by its hostname
+                device = self.devices_by_hostname.get(device_cfg["hostname"], None)
+                if device is None:
+                    logging.debug("Payload received: %s", raw_device)
+                    logging.error("Device response payload is missing a MAC identifier")
+                    continue
+            logging.debug("device before update: %s", device)
+            device.update_state(data)
+            if full_update:
+                device.last_full_update = device.last_update
+                device.full_poll_requested = False
+                if self.config.state_api_proxy:
+                    device.full_data = data
+            logging.debug("device after update: %s", device)
+            updated_devices.append(device)
+        if updated_devices:
+            with self.updated:
+                self.updated.notify_all()
+        logging.debug("devices at end: %s", self.devices)
+        logging.debug("update_states: end")
+        self.metrics.observe("cycle_seconds", time.time() - start)
+        return updated_devices
+
+    def update_all_states(self):
+        return self.update_states(self.config.devices)
 
     def refresh_all(self):
         self.update_all_states()
         for device in self.devices.values():
             device.publish_state()
 
+    def next_refresh_delay(self, hostname):
+        device = self.devices_by_hostname.get(hostname, None)
+        if device is None or time.time() - device.last_update > self.config.offline_timeout:
+            return self.config.offline_refresh_delay
+        return device.refresh_delay()
+
+    def refresh_due(self):
+        hostnames = self.scheduler.pop_due()
+        if not hostnames:
+            return
+        if self.stats_key in hostnames:
+            self.publish_stats()
+        if self.config_key in hostnames:
+            self.check_config()
+        if self.snapshot_key in hostnames:
+            self.save_snapshot()
+        for key in hostnames:
+            if isinstance(key, tuple) and key[0] == "availability" and key[1] in self.devices:
+                self.devices[key[1]].availability_expired()
+        device_cfgs = {device_cfg["hostname"]: device_cfg for device_cfg in self.config.devices}
+        for device in self.update_states([device_cfgs[hostname] for hostname in hostnames if hostname in device_cfgs]):
+            device.publish_state()
+        for hostname in hostnames:
+            if hostname in device_cfgs:
+                self.scheduler.schedule(hostname, self.next_refresh_delay(hostname))
+
     def setup(self):
         self.update_all_states()
         for device in self.devices.values():
             device.update_mqtt_config()
             logging.info("Device found: %s (%s | %s)", device.name, device.device_id, device.hostname)
 
-    def loop_start(self):
+    def reset(self):
         self.setup()
         self.register_all()
-        while True:
-            self.refresh_all()
-            time.sleep(self.delayer.next())
+        for device in self.devices.values():
+            device.publish_state(force=True)
+
+    def load_snapshot(self):
+        path = self.config.snapshot_file
+        if path is None:
+            return
+        try:
+            with open(path, 'r', encoding="utf-8") as snapshot_file:
+                snapshot = json.load(snapshot_file)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logging.warning("Could not read the snapshot file %s: %s", path, e)
+            return
+        if not isinstance(snapshot, dict) or not isinstance(snapshot.get("devices", {}), dict):
+            logging.warning("Ignoring the snapshot file %s, it is not a Cbox snapshot", path)
+            return
+
+        device_cfgs = {device_cfg["hostname"]: device_cfg for device_cfg in self.config.devices}
+        for device_id, saved in snapshot.get("devices", {}).items():
+            if not self.valid_snapshot_entry(saved):
+                logging.warning("Ignoring the snapshot of device %s, it is not valid", device_id)
+                continue
+            device_cfg = device_cfgs.get(saved.get("hostname"), None)
+            if device_cfg is None:
+                continue
+            device = Device(self, device_id, device_cfg["name"], device_cfg["hostname"])
+            device.state.update(saved.get("state", {}))
+            device.last_update = saved.get("last_update", 0)
+            device.last_full_update = saved.get("last_full_update", 0)
+            device.pellets.restore(saved.get("pellets", {}))
+            remaining = self.config.offline_timeout - (time.time() - device.last_update)
+            if remaining > 0:
+                device.availability = "online"
+                self.scheduler.schedule(device.availability_key, remaining)
+            device.update_mqtt_config()
+            self.devices[device_id] = device
+            self.devices_by_hostname[device.hostname] = device
+            logging.info("Device restored: %s (%s | %s)", device.name, device.device_id, device.hostname)
+
+    @staticmethod
+    def valid_snapshot_entry(saved):
+        return (isinstance(saved, dict)
+                and isinstance(saved.get("hostname"), str)
+                and isinstance(saved.get("state", {}), dict)
+                and isinstance(saved.get("pellets", {}), dict)
+                and isinstance(saved.get("pellets", {}).get("rates", {}), dict)
+                and all(isinstance(saved.get(key, 0), (int, float)) for key in ("last_update", "last_full_update")))
+
+    def save_snapshot(self):
+        path = self.config.snapshot_file
+        if path is None:
+            return
+        snapshot = {"devices": {device.device_id: {
+            "hostname": device.hostname,
+            "state": device.state.as_dict(),
+            "last_update": device.last_update,
+            "last_full_update": device.last_full_update,
+            "pellets": device.pellets.as_dict()
+        } for device in list(self.devices.values())}}
+        # Written next to the target and renamed over it, so a crash never leaves a truncated snapshot
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        try:
+            with open(path + ".tmp", 'w', encoding="utf-8") as snapshot_file:
+                json.dump(snapshot, snapshot_file, separators=(",", ":"))
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            logging.warning("Could not write the snapshot file %s: %s", path, e)
+        self.scheduler.schedule(self.snapshot_key, self.config.snapshot_interval)
+
+    def loop_start(self):
+        self.mqtt_client.loop_start()
+        # Publish what is known from the last run right away, then poll every box in the background
+        self.load_snapshot()
+        self.register_all()
+        for device in self.devices.values():
+            device.publish_state(force=True)
+        for device_cfg in self.config.devices:
+            self.scheduler.schedule(device_cfg["hostname"], 0)
+        if self.config.snapshot_file is not None:
+            self.scheduler.schedule(self.snapshot_key, self.config.snapshot_interval)
+        self.start_stats()
+        self.start_state_api()
+        if self.config_file_mtimes is not None and self.config.config_reload_interval:
+            self.scheduler.schedule(self.config_key, self.config.config_reload_interval)
+        self.running = True
+        while self.running:
+            if self.heartbeat is None:
+                self.scheduler.wait()
+            else:
+                # Tell the supervisor this shard is alive, often enough even when no device is due
+                self.heartbeat.value = time.time()
+                self.scheduler.wait(self.config.shard_heartbeat_timeout / 3)
+            if self.reset_requested:
+                self.reset_requested = False
+                self.reset()
+            self.refresh_due()
+
+    def stop(self):
+        self.running = False
+        self.scheduler.wakeup.set()
+        self.publish(self.config.mqtt_bridge_availability_topic, "offline", qos=1, retain=True, kind="availability")
+        self.mqtt_client.loop_stop()
+        self.save_snapshot()
+        for endpoint in self.http_endpoints.values():
+            endpoint.stop()
+        self.http_endpoints = {}
+
+    def shutdown(self):
+        # Releases everything the house holds, so that another one can be started in the same process
+        self.stop()
+        self.mqtt_client.disconnect()
+        self.poll_executor.shutdown(wait=False)
+        self.dispatcher.executor.shutdown(wait=False)
+
+    def on_connect(self, client, userdata, flags, rc):
+        # Also called on reconnections, after the broker may have published the last will
+        if rc != 0:
+            logging.error("MQTT connection refused: %s", rc)
+            return
+        logging.info("Connected to the MQTT broker")
+        if self.registered:
+            self.publish(self.config.mqtt_bridge_availability_topic, "online", qos=1, retain=True, kind="availability")
+        self.publisher.on_connect()
+
+    def on_disconnect(self, client, userdata, rc):
+        if rc != 0:
+            logging.warning("Disconnected from the MQTT broker (%s), holding messages until it is back", rc)
+        self.publisher.on_disconnect()
 
     def on_message(self, client, userdata, message):
+        # Runs in the MQTT network thread: parse and validate here, leave any call to the boxes to other threads
         if message.topic == self.config.mqtt_reset_topic:
-            self.setup()
-            self.register_all()
+            # Several resets in a row are handled once by the main loop
+            self.reset_requested = True
+            self.scheduler.wakeup.set()
+            return
+
+        self.metrics.inc("commands_received_total")
+        route = self.routes.get(message.topic, None)
+        if route is None:
+            logging.warning("MQTT message received on unknown topic '%s'", message.topic)
+            self.metrics.inc("commands_rejected_total")
+            return
+
+        device, handler, parser, to_box = route
+        try:
+            value = parser(message.payload.decode("utf-8"))
+        except ValueError as e:
+            logging.warning("MQTT message received on '%s' with invalid payload %r: %s", message.topic,
+                            message.payload, e)
+            self.metrics.inc("commands_rejected_total")
+            return
+        logging.info("MQTT message received device '%s' topic '%s' value '%s'", device.device_id, message.topic, value)
+        if not to_box:
+            # Handled by the bridge alone: no command queue, and no read back of the box state
+            handler(value)
             return
 
-        topic_tokens = message.topic.split('/')
-        # TODO validation
+        # Commands on the same topic supersede each other, the last one wins
+        device.commands.put(message.topic, handler, value)
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug("Command dispatcher: %s", self.dispatcher.stats())
 
-        device_id = topic_tokens[len(topic_tokens) - 2]
-        command = topic_tokens[len(topic_tokens) - 1]
-        value = str(message.payload.decode("utf-8"))
-        logging.info("MQTT message received device '%s' command '%s' value '%s'", device_id, command, value)
 
-        device = self.devices.get(device_id, None)
-        if device is not None:
-            device.on_message(message.topic, value)
-        self.delayer.reset()
+################
+
+def exit_on_sigterm(signum, frame):
+    # Turns SIGTERM into SystemExit, so that the bridge goes through its finally blocks and stops cleanly
+    raise SystemExit(0)
+
+
+def run_house(house):
+    # Runs the bridge until it is stopped, interrupted or terminated, then saves its snapshot and goes offline
+    try:
+        house.loop_start()
+    finally:
+        if house.running:
+            house.stop()
+
+
+def run_shard(raw_config, heartbeat):
+    # Forked shards inherit the supervisor signal handler, a shard stops its own bridge on SIGTERM
+    signal.signal(signal.SIGTERM, exit_on_sigterm)
+    house = House(Config(raw_config))
+    house.heartbeat = heartbeat
+    run_house(house)
+
+
+class Supervisor:
+    # Splits the devices across several bridge processes, and restarts the ones that exit or stop responding
+    def __init__(self, raw_config):
+        self.raw_config = raw_config
+        self.config = Config(raw_config)
+        self.processes = {}
+        self.heartbeats = {}
+        self.started = {}
+        self.delayers = {}
+        self.restart_at = {}
+
+    def shard_config(self, shard):
+        config = self.config
+        raw_config = dict(self.raw_config)
+        # Hash based so a device stays on the same shard when other devices are added or removed
+        raw_config["devices"] = [device_cfg for device_cfg in config.devices
+                                 if zlib.crc32(device_cfg["hostname"].encode("utf-8")) % config.shards == shard]
+        raw_config["shards"] = 1
+        # The supervisor owns the device split, a shard must not reload the whole device list on its own
+        raw_config["config_reload_interval"] = 0
+        if config.snapshot_file is not None:
+            raw_config["snapshot_file"] = "{}.{}".format(config.snapshot_file, shard)
+        if config.history_file is not None:
+            raw_config["history_file"] = "{}.{}".format(config.history_file, shard)
+        raw_config["mqtt_client_name"] = "{}-{}".format(config.mqtt_client_name, shard)
+        if config.metrics_port is not None:
+            raw_config["metrics_port"] = config.metrics_port + shard
+        if config.state_api_port is not None:
+            raw_config["state_api_port"] = config.state_api_port + shard
+        if config.mqtt_stats_topic is not None:
+            raw_config["mqtt_stats_topic"] = "{}/{}".format(config.mqtt_stats_topic, shard)
+        # Each shard has its own connection, hence its own last will
+        raw_config["mqtt_bridge_availability_topic"] = "{}/{}".format(config.mqtt_bridge_availability_topic, shard)
+        return raw_config
+
+    def start_shard(self, shard):
+        heartbeat = multiprocessing.Value("d", time.time())
+        process = multiprocessing.Process(target=run_shard, args=(self.shard_config(shard), heartbeat),
+                                          name="shard-{}".format(shard), daemon=True)
+        process.start()
+        logging.info("Shard %s started (pid %s)", shard, process.pid)
+        self.processes[shard] = process
+        self.heartbeats[shard] = heartbeat
+        self.started[shard] = time.time()
+
+    def stop_shard(self, shard):
+        process = self.processes.pop(shard)
+        process.terminate()
+        process.join(5)
+        if process.is_alive():
+            process.kill()
+            process.join()
+
+    def check_shard(self, shard):
+        process = self.processes.get(shard, None)
+        now = time.time()
+        if process is None:
+            if now >= self.restart_at[shard]:
+                self.start_shard(shard)
+            return
+        if process.is_alive():
+            if now - self.heartbeats[shard].value <= self.config.shard_heartbeat_timeout:
+                return
+            logging.error("Shard %s did not report for %ss, restarting it", shard, self.config.shard_heartbeat_timeout)
+            self.stop_shard(shard)
+        else:
+            logging.error("Shard %s exited with code %s", shard, process.exitcode)
+            self.processes.pop(shard)
+        # A shard that ran for a while restarts right away, one that keeps crashing waits longer and longer
+        if now - self.started[shard] > 60:
+            self.delayers[shard].reset()
+        self.restart_at[shard] = now + self.delayers[shard].next()
+
+    @staticmethod
+    def on_sigterm(signum, frame):
+        logging.info("Stopping the shards")
+        raise SystemExit(0)
+
+    def run(self):
+        logging.basicConfig(level=self.config.logging_level, format="%(asctime)-15s %(levelname)-8s %(message)s")
+        shards = [shard for shard in range(self.config.shards) if self.shard_config(shard)["devices"]]
+        # Service managers often signal only the main process: turn SIGTERM into an exit that stops the shards,
+        # instead of leaving them running with the same MQTT client names
+        signal.signal(signal.SIGTERM, self.on_sigterm)
+        for shard in shards:
+            self.delayers[shard] = Delayer([1, 5, 10, 30], 0)
+            self.start_shard(shard)
+        try:
+            while True:
+                time.sleep(1)
+                for shard in shards:
+                    self.check_shard(shard)
+        finally:
+            signal.signal(signal.SIGTERM, signal.SIG_IGN)
+            for shard in list(self.processes):
+                self.stop_shard(shard)
+
+
+def run_forever(raw_config=None):
+    # Restarts the bridge in this process when it crashes, much faster than starting a new interpreter.
+    # Without raw_config, the config files are read again on each start.
+    delayer = Delayer([0, 1, 5, 10, 30], 0)
+    while True:
+        house = None
+        started = time.time()
+        try:
+            house = House(Config(raw_config) if raw_config is not None else None)
+            house.loop_start()
+            return
+        except Exception:
+            logging.exception("Cbox crashed, restarting it")
+        finally:
+            if house is not None:
+                try:
+                    house.shutdown()
+                except Exception as e:
+                    logging.warning("Could not stop the crashed bridge cleanly: %s", e)
+        if time.time() - started > 60:
+            # It ran for a while, this is not a crash loop
+            delayer.reset()
+        time.sleep(delayer.next())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="cbox", description="Palazzetti Connection Box bridge for Home Assistant")
+    parser.add_argument("--forever", action="store_true", help="restart the bridge in the same process when it crashes")
+    args = parser.parse_args(argv)
+    raw_config = House.read_raw_config()
+    if Config(raw_config).shards > 1:
+        Supervisor(raw_config).run()
+        return
+    signal.signal(signal.SIGTERM, exit_on_sigterm)
+    if args.forever:
+        run_forever()
+    else:
+        run_house(House())
 
 
 ################
 
-House().loop_start()
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+
+# Load benchmark of the bridge against simulated Connection Boxes (see simulator.py).
+# Reports the poll cycle time, the command to state latency and the MQTT message rate for growing fleets.
+
+import argparse
+import logging
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+from Cbox import Config, House, paho_client_options
+from simulator import Behaviour, Simulator
+
+################
+
+class Recorder:
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.values = {}
+        self.messages = 0
+        self.bytes = 0
+
+    def record(self, topic, payload):
+        if isinstance(payload, bytes):
+            size = len(payload)
+        else:
+            payload = None if payload is None else str(payload)
+            size = 0 if payload is None else len(payload.encode("utf-8"))
+        with self.condition:
+            self.values[topic] = payload
+            self.messages += 1
+            self.bytes += size
+            self.condition.notify_all()
+
+    def wait_for(self, topic, value, timeout):
+        deadline = time.time() + timeout
+        with self.condition:
+            while self.values.get(topic) != value:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        return True
+
+
+class InProcessMqttClient:
+    # Stands in for both the paho client and the broker: publishes on subscribed topics are delivered back
+
+    class Message:
+        def __init__(self, topic, payload):
+            self.topic = topic
+            self.payload = payload
+
+    def __init__(self):
+        self.recorder = Recorder()
+        self.subscriptions = set()
+        self.on_message = None
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.recorder.record(topic, payload)
+        if topic in self.subscriptions and self.on_message is not None:
+            if not isinstance(payload, bytes):
+                payload = b"" if payload is None else str(payload).encode("utf-8")
+            self.on_message(self, None, self.Message(topic, payload))
+
+    def subscribe(self, topic, qos=0):
+        self.subscriptions.add(topic)
+
+    def unsubscribe(self, topic, *args):
+        self.subscriptions.discard(topic)
+
+    def loop_start(self):
+        pass
+
+    def loop_stop(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+
+class RecordingMqttClient(mqtt.Client):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.recorder = Recorder()
+
+    def publish(self, topic, payload=None, qos=0, retain=False, *args, **kwargs):
+        self.recorder.record(topic, payload)
+        return super().publish(topic, payload, qos, retain, *args, **kwargs)
+
+
+################
+
+def percentile(values, share):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(share * len(values)))]
+
+
+def make_client(args, name):
+    if args.broker is None:
+        return InProcessMqttClient()
+    host, _, port = args.broker.partition(":")
+    client = RecordingMqttClient(client_id=name, **paho_client_options(mqtt))
+    client.connect(host, int(port or 1883))
+    return client
+
+
+def run(args, count):
+    simulator = Simulator(count, Behaviour(args.latency, args.jitter, args.timeout_rate, args.error_rate)).start()
+    config = Config({
+        "devices": simulator.devices(),
+        "mqtt_state_prefix": "benchmark/state",
+        "mqtt_command_prefix": "benchmark/command",
+        "mqtt_reset_topic": "benchmark/reset",
+        "refresh_delays": [args.refresh_delay],
+        "refresh_delay_randomness": 0,
+        "poll_concurrency": args.concurrency,
+        "poll_mode": args.poll_mode,
+        "snapshot_file": None,
+        "logging_level": "WARNING"
+    })
+    client = make_client(args, "cbox-benchmark-{}".format(count))
+    recorder = client.recorder
+    house = House(config, client)
+    house.setup()
+    house.register_all()
+
+    cycle_times = []
+    for _ in range(args.cycles):
+        start = time.perf_counter()
+        house.refresh_all()
+        cycle_times.append(time.perf_counter() - start)
+
+    loop = threading.Thread(target=house.loop_start, daemon=True)
+    loop.start()
+    time.sleep(args.refresh_delay)
+
+    messages, sent_bytes, start = recorder.messages, recorder.bytes, time.perf_counter()
+    time.sleep(args.duration)
+    elapsed = time.perf_counter() - start
+    message_rate = (recorder.messages - messages) / elapsed
+    byte_rate = (recorder.bytes - sent_bytes) / elapsed
+
+    latencies = []
+    missed = 0
+    devices = list(house.devices.values())
+    for index in range(args.commands):
+        device = devices[index % len(devices)]
+        # Always a new setpoint, an unchanged value would not be published again
+        value = str(15 + (int(device.state.target_temperature) - 14) % 10)
+        start = time.perf_counter()
+        client.publish(device.command_topic("target_temp"), value)
+        if recorder.wait_for(device.state_topic("target_temp"), value, args.command_timeout):
+            latencies.append(time.perf_counter() - start)
+        else:
+            missed += 1
+
+    house.stop()
+    loop.join(args.refresh_delay + 10)
+    client.disconnect()
+    simulator.stop()
+
+    print("{:>7} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f} {:>7} {:>9.1f} {:>11.0f}".format(
+        count,
+        1000 * sum(cycle_times) / len(cycle_times), 1000 * percentile(cycle_times, .95),
+        1000 * sum(latencies) / len(latencies) if latencies else float("nan"), 1000 * percentile(latencies, .95),
+        missed, message_rate, byte_rate))
+
+
+################
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark Cbox against simulated Connection Boxes")
+    parser.add_argument("--devices", default="1,10,50,100,250,500", help="comma separated fleet sizes")
+    parser.add_argument("--cycles", type=int, default=5, help="full poll cycles measured per fleet size")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of main loop used to measure rates")
+    parser.add_argument("--commands", type=int, default=20, help="commands sent to measure command to state latency")
+    parser.add_argument("--command-timeout", type=float, default=10, help="seconds to wait for a command state")
+    parser.add_argument("--refresh-delay", type=float, default=2, help="refresh delay of every device")
+    parser.add_argument("--poll-mode", default=Config.poll_mode, choices=["full", "tiered"], help="poll_mode")
+    parser.add_argument("--concurrency", type=int, default=Config.poll_concurrency, help="poll_concurrency")
+    parser.add_argument("--latency", type=float, default=0.05, help="simulated box latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.02, help="simulated box latency jitter in seconds")
+    parser.add_argument("--timeout-rate", type=float, default=0, help="share of box requests that never answer")
+    parser.add_argument("--error-rate", type=float, default=0, help="share of box requests that fail")
+    parser.add_argument("--broker", default=None, help="host[:port] of a real MQTT broker, in-process by default")
+    args = parser.parse_args()
+
+    logging.basicConfig(level="WARNING")
+    print("{:>7} {:>9} {:>9} {:>9} {:>9} {:>7} {:>9} {:>11}".format(
+        "devices", "cycle ms", "p95 ms", "cmd ms", "p95 ms", "missed", "msg/s", "bytes/s"))
+    for count in [int(count) for count in args.devices.split(",")]:
+        run(args, count)
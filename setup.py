@@ -3,12 +3,14 @@ from setuptools import setup
 setup(
     name='Cbox',
     version='0.2.1',
-    packages=[''],
+    py_modules=['Cbox'],
     url='https://github.com/gus8313/cbox',
     license='',
     author='dotvav',
     author_email='',
-    description='Palazzetti box bridge for Home Assistant'
+    description='Palazzetti box bridge for Home Assistant',
+    install_requires=['paho-mqtt<2', 'PyYAML', 'requests'],
+    entry_points={
+        'console_scripts': ['cbox = Cbox:main'],
+    }
 )
-
-install_requires = ['paho-mqtt', 'PyYAML', 'requests']
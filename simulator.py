@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+
+# Fake Palazzetti Connection Boxes, to run Cbox and its benchmark without real stoves.
+# Every simulated stove listens on its own port and answers cgi-bin/sendmsg.lua like a box does.
+
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+################
+
+class SimulatedStove:
+    def __init__(self, index):
+        self.index = index
+        self.mac = "02:00:00:{:02X}:{:02X}:{:02X}".format((index >> 16) & 0xFF, (index >> 8) & 0xFF, index & 0xFF)
+        self.lock = threading.Lock()
+        self.setpoint = 21
+        self.room_temperature = 19.5 + random.random()
+        self.exit_temperature = 35.0
+        self.fumes_temperature = 110.0
+        self.pellet_quantity = 250.0
+        self.fan_speed = 3
+        self.power_level = 3
+        self.timer = 0
+        self.status = 6
+        self.last_tick = time.time()
+
+    def tick(self):
+        # Drift the temperatures and burn pellets so that consecutive polls do not return the same values
+        now = time.time()
+        elapsed = now - self.last_tick
+        self.last_tick = now
+        heating = self.status in (6, 7)
+        target = self.setpoint if heating else 15
+        self.room_temperature += (target - self.room_temperature) * min(elapsed / 600, 1) + random.uniform(-.05, .05)
+        self.exit_temperature = (60 if heating else 25) + random.uniform(-2, 2)
+        self.fumes_temperature = (150 if heating else 30) + random.uniform(-5, 5)
+        if heating:
+            self.pellet_quantity += elapsed * self.power_level * 0.4 / 3600
+
+    def data(self):
+        with self.lock:
+            self.tick()
+            return {
+                "MAC": self.mac,
+                "LABEL": "stove{}".format(self.index),
+                "GWDEVICE": "wlan0",
+                "APLCONN": 1,
+                "ICONN": 0,
+                "CBTYPE": "miniembplug",
+                "sendmsg": "2.1.2 2018-03-28 10:19:09",
+                "plzbridge": "2.2.1 2021-05-11 17:58:28",
+                "SYSTEM": "2.5.3 2021-05-11 19:31:01 (657c8cf)",
+                "CLOUD_ENABLED": True,
+                "EMAIL": "",
+                "MOD": 504,
+                "VER": 30,
+                "CORE": 37,
+                "FWDATE": "2020-11-30",
+                "FLUID": 0,
+                "SPLMIN": 13.0,
+                "SPLMAX": 40.0,
+                "UICONFIG": 10,
+                "MAINTPROBE": 0,
+                "STOVETYPE": 1,
+                "FAN2TYPE": 4,
+                "FAN2MODE": 3,
+                "BLEMBMODE": 0,
+                "BLEDSPMODE": 0,
+                "CHRONOTYPE": 4,
+                "AUTONOMYTYPE": 2,
+                "NOMINALPWR": 10,
+                "STATUS": self.status,
+                "LSTATUS": self.status,
+                "FSTATUS": 0,
+                "MFSTATUS": 0,
+                "SETP": self.setpoint,
+                "PUMP": 0,
+                "PQT": round(self.pellet_quantity, 1),
+                "F1V": 120,
+                "F1RPM": 1800,
+                "F2L": self.fan_speed,
+                "F2LF": 0,
+                "FANLMINMAX": [0, 5, 0, 0, 0, 0],
+                "F2V": 140,
+                "F3L": 0,
+                "F4L": 0,
+                "PWR": self.power_level,
+                "FDR": 1.9,
+                "DPT": 0,
+                "DP": 0,
+                "IN": 0,
+                "OUT": 0,
+                "T1": round(self.room_temperature, 1),
+                "T2": round(self.exit_temperature, 1),
+                "T3": round(self.fumes_temperature, 1),
+                "T4": 0.0,
+                "T5": 0.0,
+                "IGN": 12,
+                "POWERTIMEH": 950,
+                "POWERTIMEM": 13,
+                "HEATTIMEH": 871,
+                "HEATTIMEM": 2,
+                "SERVICETIME": 420,
+                "ONTIMEH": 1021,
+                "OVERTMPERRORS": 0,
+                "IGNERRORS": 1,
+                "CHRSTATUS": self.timer,
+                "EFLAGS": 0,
+                "PSENSTYPE": 0,
+                "PSENSLMAX": 0,
+                "PSENSLTSH": 0,
+                "PSENSLMIN": 0,
+                "PLEVEL": 0,
+                "PELLETTYPE": 1
+            }
+
+    def execute(self, command):
+        # Returns the DATA block of the answer, or None if the box does not know the command
+        tokens = command.split(" ")
+        if tokens[:2] == ["GET", "ALLS"]:
+            return self.data()
+        if tokens[:2] == ["GET", "TMPS"]:
+            data = self.data()
+            return {key: data[key] for key in ("T1", "T2", "T3", "T4", "T5")}
+        if tokens[:2] == ["GET", "STAT"]:
+            data = self.data()
+            return {key: data[key] for key in ("STATUS", "LSTATUS", "FSTATUS")}
+        with self.lock:
+            if tokens[:2] == ["CMD", "ON"]:
+                self.status = 6
+            elif tokens[:2] == ["CMD", "OFF"]:
+                self.status = 0
+            elif len(tokens) == 3 and tokens[0] == "SET" and tokens[1] in ("SETP", "STPF"):
+                self.setpoint = float(tokens[2]) if tokens[1] == "STPF" else int(float(tokens[2]))
+                return {"SETP": self.setpoint}
+            elif len(tokens) == 3 and tokens[0] == "SET" and tokens[1] == "RFAN":
+                self.fan_speed = int(tokens[2])
+                return {"F2L": self.fan_speed}
+            elif len(tokens) == 3 and tokens[0] == "SET" and tokens[1] == "POWR":
+                self.power_level = int(tokens[2])
+                return {"PWR": self.power_level}
+            elif len(tokens) == 3 and tokens[0] == "SET" and tokens[1] == "CSST":
+                self.timer = int(tokens[2])
+                return {"CHRSTATUS": self.timer}
+            else:
+                return None
+            return {"STATUS": self.status, "LSTATUS": self.status}
+
+
+################
+
+class SimulatorRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        behaviour = self.server.behaviour
+        delay = max(behaviour.latency + random.uniform(-behaviour.jitter, behaviour.jitter), 0)
+        if random.random() < behaviour.timeout_rate:
+            # Hang long enough for the client to give up, like a box that stopped answering
+            time.sleep(behaviour.hang_time)
+            self.close_connection = True
+            return
+        time.sleep(delay)
+        if random.random() < behaviour.error_rate:
+            self.reply(500, {"SUCCESS": False})
+            return
+
+        url = urlparse(self.path)
+        if url.path != "/cgi-bin/sendmsg.lua":
+            self.reply(404, {"SUCCESS": False})
+            return
+        command = parse_qs(url.query).get("cmd", [""])[0]
+        data = self.server.stove.execute(command)
+        if data is None:
+            self.reply(200, {"INFO": {"CMD": command, "RSP": "ERROR"}, "SUCCESS": False, "DATA": {}})
+        else:
+            self.reply(200, {"INFO": {"CMD": command, "RSP": "OK", "TS": int(time.time())}, "SUCCESS": True,
+                             "DATA": data})
+
+    def reply(self, status_code, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status_code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Behaviour:
+    def __init__(self, latency=0.05, jitter=0.02, timeout_rate=0, error_rate=0, hang_time=10):
+        self.latency = latency
+        self.jitter = jitter
+        self.timeout_rate = timeout_rate
+        self.error_rate = error_rate
+        self.hang_time = hang_time
+
+
+class Simulator:
+    def __init__(self, count, behaviour=None, host="127.0.0.1", base_port=0):
+        self.behaviour = behaviour if behaviour is not None else Behaviour()
+        self.host = host
+        self.base_port = base_port
+        self.stoves = [SimulatedStove(index) for index in range(count)]
+        self.servers = []
+
+    def start(self):
+        for stove in self.stoves:
+            port = self.base_port + stove.index if self.base_port else 0
+            server = ThreadingHTTPServer((self.host, port), SimulatorRequestHandler)
+            server.daemon_threads = True
+            server.stove = stove
+            server.behaviour = self.behaviour
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            self.servers.append(server)
+        return self
+
+    def stop(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        self.servers = []
+
+    def devices(self):
+        # Ready to be used as the "devices" entry of the Cbox config
+        return [{"name": "Simulated stove {}".format(server.stove.index),
+                 "hostname": "{}:{}".format(self.host, server.server_address[1])}
+                for server in self.servers]
+
+
+################
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulate Palazzetti Connection Boxes")
+    parser.add_argument("--stoves", type=int, default=1, help="number of simulated stoves")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on")
+    parser.add_argument("--port", type=int, default=8080, help="port of the first stove, the next ones follow")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds before each answer")
+    parser.add_argument("--jitter", type=float, default=0.02, help="random seconds added to or removed from latency")
+    parser.add_argument("--timeout-rate", type=float, default=0, help="share of requests that never get an answer")
+    parser.add_argument("--error-rate", type=float, default=0, help="share of requests answered with HTTP 500")
+    args = parser.parse_args()
+
+    simulator = Simulator(args.stoves, Behaviour(args.latency, args.jitter, args.timeout_rate, args.error_rate),
+                          args.host, args.port).start()
+    print("devices:")
+    for device in simulator.devices():
+        print("  - name: {}\n    hostname: {}".format(device["name"], device["hostname"]))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        simulator.stop()